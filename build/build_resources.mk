@@ -25,7 +25,7 @@ PAL_RES_FILES := $(wildcard $(LOCAL_BUILD_RES_PAL)/*.pal)
 built_spr_res := $(patsubst $(LOCAL_BUILD_RES_SPR)/%.tga,$(LOCAL_BUILD_OUT_GEN)/%.h,$(SPR_RES_FILES))
 built_spr_res_png := $(patsubst $(LOCAL_BUILD_RES_SPR)/%.png,$(LOCAL_BUILD_OUT_GEN)/%.h,$(SPR_RES_FILES_PNG))
 built_spr2_res_png := $(patsubst $(LOCAL_BUILD_RES_SPR2)/%.png,$(LOCAL_BUILD_OUT_GEN)/%.h,$(SPR2_RES_FILES_PNG))
-built_map_res := $(patsubst $(LOCAL_BUILD_RES_MAP)/%.json,$(LOCAL_BUILD_OUT_GEN)/%.h,$(MAP_RES_FILES))
+built_map_res := $(patsubst $(LOCAL_BUILD_RES_MAP)/%.json,$(LOCAL_BUILD_OUT_GEN)/%.map.stamp,$(MAP_RES_FILES))
 built_til_res := $(patsubst $(LOCAL_BUILD_RES_TIL)/%.tga,$(LOCAL_BUILD_OUT_GEN)/%.h,$(TIL_RES_FILES))
 built_til_res_png := $(patsubst $(LOCAL_BUILD_RES_TIL)/%.png,$(LOCAL_BUILD_OUT_GEN)/%.h,$(TIL_RES_FILES_PNG))
 built_raw_res := $(patsubst $(LOCAL_BUILD_RES_RAW)/%.tga,$(LOCAL_BUILD_OUT_GEN)/%.h,$(RAW_RES_FILES))
@@ -39,6 +39,7 @@ built_fnt_res := $(patsubst $(LOCAL_BUILD_RES_FNT)/%.tga,$(LOCAL_BUILD_OUT_GEN)/
 built_fnt_res_png := $(patsubst $(LOCAL_BUILD_RES_FNT)/%.png,$(LOCAL_BUILD_OUT_GEN)/%.h,$(FNT_RES_FILES_PNG))
 built_bmp_res := $(patsubst $(LOCAL_BUILD_RES_BMP)/%.png,$(LOCAL_BUILD_OUT_GEN)/%.h,$(BMP_RES_FILES))
 built_pal_res := $(patsubst $(LOCAL_BUILD_RES_PAL)/%.pal,$(LOCAL_BUILD_OUT_GEN)/%.h,$(PAL_RES_FILES))
+built_pal_batch_res := $(if $(and $(filter enabled,$(LOCAL_PAL_BATCH)),$(PAL_RES_FILES)),$(LOCAL_BUILD_OUT_GEN)/all_palettes.h)
 
 built_spr_ext_res := $(patsubst $(LOCAL_BUILD_RES_SPR)/%.tga,$(LOCAL_BUILD_OUT_GEN)/%_ext.h,$(SPR_RES_FILES))
 built_til_ext_res := $(patsubst $(LOCAL_BUILD_RES_TIL)/%.tga,$(LOCAL_BUILD_OUT_GEN)/%_ext.h,$(TIL_RES_FILES))
@@ -57,13 +58,26 @@ all: $(built_spr_res) $(built_map_res) $(built_til_res) $(built_spr_ext_res) $(b
 	$(built_spr_ext_res_png) $(built_til_ext_res_png) $(built_raw_ext_res_png) \
 	$(built_fnt_ext_res_png) $(built_spr_res_png) $(built_spr2_res_png) $(built_til_res_png) \
 	$(built_raw_res_png) $(built_fnt_res_png) $(built_bmp_res) $(built_bmp_ext_res) \
-	$(built_pal_res) | $(TGA2H) $(TILED2H)
+	$(built_pal_res) $(built_pal_batch_res) | $(TGA2H) $(TILED2H)
 
-$(built_map_res) : $(LOCAL_BUILD_OUT_GEN)/%.h: $(LOCAL_BUILD_RES_MAP)/%.json
+# map headers are only rewritten when their content changes, so the rule
+# tracks a stamp file instead of the generated headers
+#
+# with LOCAL_MAP_BINARY := enabled tile layers are written as .bin blobs,
+# each turned into a C array by xxd and included after the map headers
+$(built_map_res) : $(LOCAL_BUILD_OUT_GEN)/%.map.stamp: $(LOCAL_BUILD_RES_MAP)/%.json | $(XXD)
 	$(hide) mkdir -p $(LOCAL_BUILD_OUT_GEN)
 		$(call print_res, map, $^)
-	$(hide) $(TILED2H) -s $^ -o $@
-	$(hide) @echo '#include "$@"' >> $(LOCAL_BUILD_OUT_GEN)/$(LOCAL_ROM_NAME).h
+	$(hide) $(TILED2H) -c $(MAP_CACHE)$(if $(filter enabled,$(LOCAL_MAP_BINARY)), -b) -s $^ -o $(LOCAL_BUILD_OUT_GEN)/$*.h
+	$(hide) @echo '#include "$(LOCAL_BUILD_OUT_GEN)/$*.h"' >> $(LOCAL_BUILD_OUT_GEN)/$(LOCAL_ROM_NAME).h
+ifeq ($(LOCAL_MAP_BINARY),enabled)
+	$(hide) cd $(LOCAL_BUILD_OUT_GEN) && for blob in $*_*.bin; do \
+		[ -f $$blob ] || continue; \
+		$(XXD) -i $$blob > $$blob.h; \
+		echo "#include \"$(LOCAL_BUILD_OUT_GEN)/$$blob.h\"" >> $(LOCAL_ROM_NAME).h; \
+	done
+endif
+	$(hide) touch $@
 
 $(built_til_res) : $(LOCAL_BUILD_OUT_GEN)/%.h: $(LOCAL_BUILD_RES_TIL)/%.tga
 	$(hide) mkdir -p $(LOCAL_BUILD_OUT_GEN)
@@ -213,8 +227,19 @@ $(built_bmp_ext_res) : $(LOCAL_BUILD_OUT_GEN)/%_ext.h: $(LOCAL_BUILD_RES_BMP)/%.
 	$(hide) $(PNG2H) -p -t SCR5H -f $^ -o $@
 	$(hide) @echo '#include "$@"' >> $(LOCAL_BUILD_OUT_GEN)/$(LOCAL_ROM_NAME)_bitmaps_ext.h
 
+# with LOCAL_PAL_FADE := black white each palette header also has its fade
+# tables, of LOCAL_PAL_STEPS steps when set
 $(built_pal_res) : $(LOCAL_BUILD_OUT_GEN)/%.h: $(LOCAL_BUILD_RES_PAL)/%.pal
 	$(hide) mkdir -p $(LOCAL_BUILD_OUT_GEN)
 	$(call print_res, pal, $^)
-	$(hide) $(PAL2H) -s $^ -o $@
+	$(hide) $(PAL2H) -s $^ -o $@$(foreach fade,$(LOCAL_PAL_FADE), -f $(fade))$(if $(LOCAL_PAL_STEPS), -n $(LOCAL_PAL_STEPS))
+	$(hide) @echo '#include "$@"' >> $(LOCAL_BUILD_OUT_GEN)/$(LOCAL_ROM_NAME).h
+
+# with LOCAL_PAL_BATCH := enabled all palettes are also merged in a single
+# all_palettes.h header, in the format of the VDP palette port read by
+# vdp_load_palette
+$(built_pal_batch_res) : $(PAL_RES_FILES)
+	$(hide) mkdir -p $(LOCAL_BUILD_OUT_GEN)
+	$(call print_res, pal, $^)
+	$(hide) $(PAL2H) --vdp -o $@ $^
 	$(hide) @echo '#include "$@"' >> $(LOCAL_BUILD_OUT_GEN)/$(LOCAL_ROM_NAME).h
@@ -13,6 +13,7 @@ export LOCAL_BUILD_RES_FNT = $(LOCAL_BUILD_RES)/font
 export LOCAL_BUILD_RES_BMP = $(LOCAL_BUILD_RES)/bmp
 export LOCAL_BUILD_RES_PAL = $(LOCAL_BUILD_RES)/pal
 export LOCAL_BUILD_OUT_GEN = $(CURDIR)/gen
+export MAP_CACHE = $(BUILD_OUT)/cache/map
 export LOCAL_BUILD_OUT_ROM = $(LOCAL_BUILD_OUT)/rom
 export LOCAL_BUILD_OUT_BIN = $(LOCAL_BUILD_OUT)/bin
 export LOCAL_BUILD_OUT_COM = $(LOCAL_BUILD_OUT)/com
@@ -95,6 +95,12 @@ test:
 	$(MAKE) -C $(RLE_TEST) all
 rle: #test
 
+# Run the host tests of the tools
+#
+.PHONY: host_test
+host_test:
+	$(MAKE) -C $(RLE_TOOLS)/tests all
+
 # Build ROMS
 #
 .PHONY: roms
@@ -22,6 +22,44 @@
 #ifndef _MSX_H_MAP
 #define _MSX_H_MAP
 
+/*
+ * Tile layer encodings, map2header writes the one used by each layer as
+ * <MAP>_<LAYER>_MODE in the map _defs.h header.
+ */
+#define MAP_MODE_RAW 0
+#define MAP_MODE_RLE 1
+#define MAP_MODE_BLOCK 2
+#define MAP_MODE_SEGMENT_RLE 3
+#define MAP_MODE_SEGMENT_BLOCK 4
+#define MAP_MODE_SEGMENT_RAW 5
+#define MAP_MODE_LZ 6
+#define MAP_MODE_SEGMENT_LZ 7
+#define MAP_MODE_SEGMENT_SHARED 8
+
+/*
+ * Block index formats of block compressed layers with more than 256 blocks,
+ * written by map2header as <MAP>_<LAYER>_BLOCK_INDEX:
+ *
+ *   wide: indexes are 16 bit words, use map_inflate_block_wide
+ *   escape: use map_inflate_block_escape
+ *   regions: the map is split in bands of rows, each with its own dictionary
+ *     of up to 256 blocks, <MAP>_<LAYER>_region<n>_row is the first tile row
+ *     of a band, to be inflated with map_inflate_block
+ */
+#define MAP_BLOCK_INDEX_BYTE 0
+#define MAP_BLOCK_INDEX_WIDE 1
+#define MAP_BLOCK_INDEX_ESCAPE 2
+#define MAP_BLOCK_INDEX_REGIONS 3
+#define MAP_BLOCK_ESCAPE 0xff
+
+/*
+ * Inflate a block compressed layer using the block geometry recorded by
+ * map2header as <MAP>_<LAYER>_BLOCK_W and <MAP>_<LAYER>_BLOCK_H
+ */
+#define map_inflate_layer_blocks(DICT, DATA, BUF, SIZE, W, GEOMETRY)           \
+  map_inflate_block(DICT, DATA, BUF, SIZE, W, GEOMETRY##_BLOCK_W,              \
+                    GEOMETRY##_BLOCK_H)
+
 #define map_inflate_screen(MAP, BUF, X, Y)                                     \
   __map_inflate_screen(MAP##_cmpr_dict, MAP, BUF, MAP##_w, X, Y);
 
@@ -29,5 +67,19 @@ void map_inflate(const uint8_t *dict, const uint8_t *in, uint8_t *out,
                  uint16_t data_size, uint8_t w) __nonbanked;
 void __map_inflate_screen(const uint8_t *dict, const uint16_t *in, uint8_t *out,
                           uint8_t w, uint8_t vpx, uint8_t vpy) __nonbanked;
+void map_inflate_block(const uint8_t *dict, const uint8_t *in, uint8_t *out,
+                       uint16_t data_size, uint8_t w, uint8_t bw,
+                       uint8_t bh) __nonbanked;
+void map_inflate_block_wide(const uint8_t *dict, const uint16_t *in,
+                            uint8_t *out, uint16_t data_size, uint8_t w,
+                            uint8_t bw, uint8_t bh) __nonbanked;
+void map_inflate_block_escape(const uint8_t *dict, const uint8_t *in,
+                              uint8_t *out, uint16_t data_size, uint8_t w,
+                              uint8_t bw, uint8_t bh) __nonbanked;
+void map_stream_column(const uint8_t *strips, const uint16_t *offsets,
+                       uint8_t col, uint8_t y, uint8_t vcol) __nonbanked;
+void map_stream_row(const uint8_t *strips, const uint16_t *offsets,
+                    uint8_t row, uint8_t x, uint8_t vrow) __nonbanked;
+void map_inflate_lz(const uint8_t *in, uint8_t *out) __nonbanked;
 
 #endif
@@ -92,6 +92,15 @@ typedef enum {
 
 } TileCollisionType;
 
+/**
+ * Collision classes of the packed collision maps generated by map2header
+ * from the rl_collision tile property
+ */
+#define PHYS_COLLISION_NONE 0
+#define PHYS_COLLISION_FULL 1
+#define PHYS_COLLISION_DOWN 2
+#define PHYS_COLLISION_TRIGGER 3
+
 /**
  * Defines a TileCollisionHandler
  */
@@ -170,5 +179,7 @@ void phys_clear_colliding_tile(uint8_t tile);
 void phys_detect_tile_collisions(DisplayObject *obj, uint8_t *map, int8_t dx,
                                  int8_t dy, bool duck, bool notify) __nonbanked;
 void phys_set_colliding_tile_set(TileSet *ts);
+void phys_set_collision_map(const uint8_t *bitmap, const uint16_t *rows, uint8_t bits);
+uint8_t phys_get_collision(uint8_t x, uint8_t y) __nonbanked;
 
 #endif
@@ -229,6 +229,10 @@ extern void tile_set_to_vram(TileSet *tileset, uint8_t offset);
 extern void tile_set_to_vram_bank_raw(TileSet *tileset, TileBank bank,
                                       uint8_t offset);
 extern void tile_set_to_vram_raw(TileSet *tileset, uint8_t offset);
+extern void tile_set_tiles_to_vram(TileSet *tileset, uint8_t pos,
+                                   const uint8_t *tiles, uint16_t count);
+extern void tile_set_remapped_to_vram(TileSet *tileset, uint8_t pos,
+                                      const uint8_t *patterns, uint16_t count);
 extern void tile_object_show(TileObject *tileobject, uint8_t *scrbuf,
                              bool refresh_vram) __nonbanked;
 extern void tile_object_hide(TileObject *tileobject, uint8_t *scrbuf,
@@ -297,6 +297,7 @@ extern uint8_t vdp_5th_sprite() __nonbanked;
 /* MSX2 and above */
 extern void vdp_set_palette(VdpRGBColor *palette);
 extern void vdp_set_palette_color(uint8_t index, VdpRGBColor *color);
+extern void vdp_load_palette(const uint8_t *data, uint8_t size) __nonbanked;
 extern void vdp_write_reg(uint8_t reg, uint8_t val) __nonbanked;
 extern void vdp_set_vram_page(uint8_t page) __nonbanked;
 extern void vdp_exec(VdpCommand *cmd) __nonbanked;
@@ -19,6 +19,7 @@
 
 #include "map.h"
 #include "msx.h"
+#include "vdp.h"
 
 #pragma CODE_PAGE 2
 
@@ -52,6 +53,118 @@ void map_inflate(const uint8_t *dict, uint8_t *in, uint8_t *out,
   }
 }
 
+/**
+ * read a buffer and expand it using a dictionary of bw x bh tile blocks,
+ *  as map_inflate does for 2x2 blocks. Each dictionary entry holds the
+ *  tiles of a block row by row.
+ *
+ *   width of the map is needed, and must be a multiple of bw
+ *   out buffer needs to be bw * bh times data_size
+ */
+void map_inflate_block(const uint8_t *dict, const uint8_t *in, uint8_t *out,
+                       uint16_t data_size, uint8_t w, uint8_t bw,
+                       uint8_t bh) __nonbanked {
+  uint8_t col = 0;
+  uint8_t x, y;
+  uint8_t size = bw * bh;
+  uint16_t skip = w * (bh - 1);
+  const uint8_t *src;
+  const uint8_t *block;
+  uint8_t *dst = out;
+  uint8_t *row;
+
+  for (src = in; src < in + data_size; src++) {
+    block = dict + (*src) * size;
+    row = dst;
+    for (y = 0; y < bh; y++) {
+      for (x = 0; x < bw; x++)
+        row[x] = *block++;
+      row += w;
+    }
+    col += bw;
+    dst += bw;
+    if (col >= w) {
+      col = 0;
+      dst += skip;
+    }
+  }
+}
+
+/**
+ * same as map_inflate_block for dictionaries of more than 256 blocks,
+ *  indexed by 16 bit words
+ */
+void map_inflate_block_wide(const uint8_t *dict, const uint16_t *in,
+                            uint8_t *out, uint16_t data_size, uint8_t w,
+                            uint8_t bw, uint8_t bh) __nonbanked {
+  uint8_t col = 0;
+  uint8_t x, y;
+  uint8_t size = bw * bh;
+  uint16_t skip = w * (bh - 1);
+  const uint16_t *src;
+  const uint8_t *block;
+  uint8_t *dst = out;
+  uint8_t *row;
+
+  for (src = in; src < in + data_size; src++) {
+    block = dict + (*src) * size;
+    row = dst;
+    for (y = 0; y < bh; y++) {
+      for (x = 0; x < bw; x++)
+        row[x] = *block++;
+      row += w;
+    }
+    col += bw;
+    dst += bw;
+    if (col >= w) {
+      col = 0;
+      dst += skip;
+    }
+  }
+}
+
+/**
+ * same as map_inflate_block for dictionaries of more than 256 blocks,
+ *  where the 255 most used blocks take a byte and the rest are written as
+ *  MAP_BLOCK_ESCAPE followed by a little endian 16 bit index.
+ *
+ *   data_size is the size of the stream in bytes
+ */
+void map_inflate_block_escape(const uint8_t *dict, const uint8_t *in,
+                              uint8_t *out, uint16_t data_size, uint8_t w,
+                              uint8_t bw, uint8_t bh) __nonbanked {
+  uint8_t col = 0;
+  uint8_t x, y;
+  uint8_t size = bw * bh;
+  uint16_t skip = w * (bh - 1);
+  uint16_t idx;
+  const uint8_t *src = in;
+  const uint8_t *block;
+  uint8_t *dst = out;
+  uint8_t *row;
+
+  while (src < in + data_size) {
+    idx = *src++;
+    if (idx == MAP_BLOCK_ESCAPE) {
+      idx = src[0] | (src[1] << 8);
+      src += 2;
+    }
+    block = dict + idx * size;
+    row = dst;
+    for (y = 0; y < bh; y++) {
+      for (x = 0; x < bw; x++)
+        row[x] = *block++;
+      row += w;
+    }
+    col += bw;
+    dst += bw;
+    if (col >= w) {
+      col = 0;
+      dst += skip;
+    }
+  }
+}
+
 /**
  * Inflate only a 32x24 window of the map to a buffer, useful if the map is too
  * big to be decompressed entirely.
@@ -76,3 +189,96 @@ void __map_inflate_screen(const uint8_t *dict, uint16_t *in, uint8_t *out,
     }
   }
 }
+
+/**
+ * Stream one column of a map laid out in column strips (rl_scroll) to the
+ * name table, as needed for a horizontal scroll step.
+ *
+ * :param strips: column strips, <MAP>_<LAYER>_columns
+ * :param offsets: offset of each column strip, <MAP>_<LAYER>_column_offset
+ * :param col: map column to stream
+ * :param y: first map row of the screen
+ * :param vcol: screen column to write to
+ */
+void map_stream_column(const uint8_t *strips, const uint16_t *offsets,
+                       uint8_t col, uint8_t y, uint8_t vcol) __nonbanked {
+  const uint8_t *src = strips + offsets[col] + y;
+  uint16_t addr = VRAM_BASE_NAME + vcol;
+  uint8_t i;
+
+  for (i = 0; i < 24; i++) {
+    vdp_write(addr, *src++);
+    addr += 32;
+  }
+}
+
+/**
+ * Stream one row of a map laid out in row strips (rl_scroll) to the name
+ * table, as needed for a vertical scroll step.
+ *
+ * :param strips: row strips, <MAP>_<LAYER>_rows
+ * :param offsets: offset of each row strip, <MAP>_<LAYER>_row_offset
+ * :param row: map row to stream
+ * :param x: first map column of the screen
+ * :param vrow: screen row to write to
+ */
+void map_stream_row(const uint8_t *strips, const uint16_t *offsets,
+                    uint8_t row, uint8_t x, uint8_t vrow) __nonbanked {
+  vdp_memcpy(VRAM_BASE_NAME + vrow * 32, (uint8_t *)strips + offsets[row] + x,
+             32);
+}
+
+/**
+ * Inflate a stream compressed with the map2header lz mode, either a whole
+ * map or a single segment. A 32x24 segment fits a 768 byte screen buffer.
+ *
+ * Each token byte is followed by its data:
+ *   0x01-0x7f  n literal tiles, copied to the output
+ *   0x80-0xff  copy (n & 0x7f) + 3 tiles already in the output, starting at a
+ *              little endian 16 bit offset back from the current position
+ *   0x00       end of stream
+ *
+ * Copies may overlap the output, ldir replicates them as a run.
+ *
+ * :param in: lz stream
+ * :param out: output buffer, big enough for the inflated data
+ */
+void map_inflate_lz(const uint8_t *in, uint8_t *out) __nonbanked {
+  unused(in);
+  unused(out);
+
+  __asm
+  ld l, 4 (ix)
+  ld h, 5 (ix)
+  ld e, 6 (ix)
+  ld d, 7 (ix)
+  ld b, #0
+lz_token:
+  ld a, (hl)
+  inc hl
+  or a
+  jr z, lz_end
+  jp m, lz_match
+  ld c, a
+  ldir
+  jr lz_token
+lz_match:
+  and #0x7f
+  add a, #3
+  ld c, a
+  push de
+  ld e, (hl)
+  inc hl
+  ld d, (hl)
+  inc hl
+  ex (sp), hl
+  push hl
+  or a
+  sbc hl, de
+  pop de
+  ldir
+  pop hl
+  jr lz_token
+lz_end:
+  __endasm;
+}
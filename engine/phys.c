@@ -48,6 +48,11 @@ static TileCollisionDef tile_collision[MAX_COLLISION_DEFS];
 /* Tile collision definition count */
 static uint8_t collision_ctr;
 
+/* Packed collision map of the current segment, see phys_set_collision_map */
+static const uint8_t *collision_map;
+static const uint16_t *collision_rows;
+static uint8_t collision_bits;
+
 /* Sprite collision detection callback */
 static void (*sprite_collision_cb)();
 
@@ -277,6 +282,37 @@ void phys_set_colliding_tile_set(TileSet *ts) {
   }
 }
 
+/**
+ * Set the packed collision map of the current segment
+ *
+ * Collision maps are generated by map2header from the rl_collision tile
+ * property, with the collision class of every tile packed in 1 or 2 bits.
+ *
+ * :param bitmap: the collision map of the segment
+ * :param rows: offset of each row in the collision map
+ * :param bits: bits per tile, 1 or 2
+ */
+void phys_set_collision_map(const uint8_t *bitmap, const uint16_t *rows, uint8_t bits) {
+  collision_map = bitmap;
+  collision_rows = rows;
+  collision_bits = bits;
+}
+
+/**
+ * Get the collision class of a tile from the packed collision map
+ *
+ * :param x: column of the tile in the segment
+ * :param y: row of the tile in the segment
+ * :returns: one of PHYS_COLLISION_NONE, FULL, DOWN or TRIGGER
+ */
+uint8_t phys_get_collision(uint8_t x, uint8_t y) __nonbanked {
+  const uint8_t *row = collision_map + collision_rows[y];
+
+  if (collision_bits == 1)
+    return (row[x >> 3] >> (x & 7)) & 1;
+  return (row[x >> 2] >> ((x & 3) << 1)) & 3;
+}
+
 /*
  * if the tile has a handler set, notify
  */
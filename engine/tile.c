@@ -264,6 +264,67 @@ void tile_set_to_vram_raw(TileSet *tileset, uint8_t offset) {
   tile_set_to_vram_bank_raw(tileset, ALLBANKS, offset);
 }
 
+/*
+ * Copy the pattern and color of a tile of a raw TileSet to a position in
+ * all banks, if the tile belongs to the TileSet placed at pos
+ */
+static void tile_pattern_to_vram(TileSet *tileset, uint8_t pos, uint8_t tile,
+                                 uint8_t slot) {
+  uint16_t src, dst;
+
+  if (tile < pos || tile - pos >= tileset->w * tileset->h)
+    return;
+
+  src = (tile - pos) * 8;
+  dst = slot * 8;
+  vdp_memcpy(VRAM_BASE_PTRN + dst, tileset->pattern + src, 8);
+  vdp_memcpy(VRAM_BASE_COLR + dst, tileset->color + src, 8);
+  vdp_memcpy(VRAM_BASE_PTRN + dst + BANK1_OFFSET, tileset->pattern + src, 8);
+  vdp_memcpy(VRAM_BASE_COLR + dst + BANK1_OFFSET, tileset->color + src, 8);
+  vdp_memcpy(VRAM_BASE_PTRN + dst + BANK2_OFFSET, tileset->pattern + src, 8);
+  vdp_memcpy(VRAM_BASE_COLR + dst + BANK2_OFFSET, tileset->color + src, 8);
+}
+
+/**
+ * Transfer to VRAM only the tiles of a raw TileSet used by a map
+ *
+ * The list of used tiles, of the whole map or of a segment, is generated by
+ * map2header with the rl_tiles property. Tiles not in the TileSet are
+ * skipped, so every TileSet of a map can be given the same list.
+ *
+ * :param tileset: raw TileSet holding the tiles
+ * :param pos: position of the TileSet in VRAM the map was drawn for
+ * :param tiles: list of tiles to transfer, each to its own position
+ * :param count: number of tiles in the list
+ */
+void tile_set_tiles_to_vram(TileSet *tileset, uint8_t pos,
+                            const uint8_t *tiles, uint16_t count) {
+  uint16_t i;
+
+  for (i = 0; i < count; i++)
+    tile_pattern_to_vram(tileset, pos, tiles[i], tiles[i]);
+}
+
+/**
+ * Transfer to VRAM the tiles of a raw TileSet used by a remapped map
+ *
+ * Maps generated by map2header with the rl_tiles property set to remap
+ * number their tiles densely, the patterns table holds the tile each number
+ * replaces. Tiles not in the TileSet are skipped.
+ *
+ * :param tileset: raw TileSet holding the tiles
+ * :param pos: position of the TileSet in VRAM the map was drawn for
+ * :param patterns: tile replaced by each number
+ * :param count: number of entries in patterns
+ */
+void tile_set_remapped_to_vram(TileSet *tileset, uint8_t pos,
+                               const uint8_t *patterns, uint16_t count) {
+  uint16_t i;
+
+  for (i = 0; i < count; i++)
+    tile_pattern_to_vram(tileset, pos, patterns[i], i);
+}
+
 /**
  * Free a previously allocated TileSet
  *
@@ -172,6 +172,35 @@ void vdp_set_palette_color(uint8_t index, VdpRGBColor *color)
   __endasm;
 }
 
+/**
+ * Copies colors already packed in the VDP palette format (two bytes per
+ * color, 0RRR0BBB 00000GGG) to the palette port starting at color 0 (MSX2)
+ *
+ * This is meant for the fade and transition tables generated by pal2header,
+ * where each step of a fade is a single call.
+ *
+ * :param data: packed palette
+ * :param size: size in bytes, two per color
+ */
+void vdp_load_palette(const uint8_t *data, uint8_t size) __nonbanked
+{
+  unused(data);
+  unused(size);
+
+  vdp_write_reg(V99xx_SET_PALETTE_REG, 0);
+
+  __asm
+  ld l,4(ix)
+  ld h,5(ix)
+  ld b,6(ix)
+  lda_main_rom(VDP_DW)
+  inc a
+  inc a
+  ld c,a
+  otir
+  __endasm;
+}
+
 void vdp_write_reg(uint8_t reg, uint8_t val) __nonbanked
 {
   unused(reg);
@@ -16,12 +16,483 @@
 #   You should have received a copy of the GNU General Public License along with
 #   this program; If not, see <http://www.gnu.org/licenses/>.
 #
+import base64
+import glob
+import gzip
+import hashlib
+import heapq
+import io
 import json
 import ntpath
 import os
+import struct
 import sys
+import time
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import cached_property
 from optparse import OptionParser
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# values accepted by the rl_compr map property, besides 'auto'
+COMPRESSORS = ('rle', 'block', 'lz', 'shared')
+
+# tile layer modes, see TileLayer.dump_as_c_header
+MODE_NAMES = {0: 'none', 1: 'rle', 2: 'block', 3: 'rle', 4: 'block', 5: 'none', 6: 'lz', 7: 'lz', 8: 'shared'}
+
+# LZ stream limits, see TileLayer.compress_lz and map_inflate_lz
+LZ_MAX_LITERAL = 127
+LZ_MIN_MATCH = 3
+LZ_MAX_MATCH = 130
+LZ_WINDOW = 0xffff
+LZ_CHAIN = 32           # previous occurrences tried when looking for a match
+
+# block sizes accepted by the rl_block map property, as (width, height)
+BLOCK_SIZES = ((2, 2), (4, 4), (2, 1), (1, 2))
+
+# strip layouts accepted by the rl_scroll map property
+SCROLL_LAYOUTS = {'columns': ('column',), 'rows': ('row',), 'both': ('column', 'row')}
+
+# tile usage analysis asked by the rl_tiles map property: 'used' lists the tiles
+# used by the layer and by each segment, 'remap' also renumbers them densely
+TILE_USAGES = ('used', 'remap')
+
+# values of the rl_collision tile property, as classes of the packed collision
+# maps, see phys_get_collision
+COLLISION_CLASSES = {'none': 0, 'solid': 1, 'full': 1, 'platform': 2, 'down': 2, 'trigger': 3}
+
+# block index formats, used when a dictionary grows over 256 blocks
+BLOCK_INDEX_BYTE = 0        # one byte per block
+BLOCK_INDEX_WIDE = 1        # one word per block
+BLOCK_INDEX_ESCAPE = 2      # one byte, or BLOCK_ESCAPE and a word for the least used blocks
+BLOCK_INDEX_REGIONS = 3     # bands of rows with their own dictionary of up to 256 blocks
+BLOCK_INDEX_NAMES = {0: 'byte', 1: 'wide', 2: 'escape', 3: 'regions'}
+BLOCK_ESCAPE = 0xff
+
+
+def write_if_changed(path, content):
+    """
+    Write content (str or bytes) to path unless the file already has exactly
+    that content, so unchanged outputs keep their mtime. Returns True if the
+    file was written.
+    """
+    binary = 'b' if isinstance(content, bytes) else ''
+    if os.path.exists(path):
+        with open(path, 'r' + binary) as f:
+            if f.read() == content:
+                return False
+    with open(path, 'w' + binary) as f:
+        f.write(content)
+    return True
+
+
+def decode_layer_data(raw):
+    """
+    Return the tiles of a Tiled tile layer. Layers saved with base64 encoding,
+    optionally compressed with zlib, gzip or zstd, are decoded straight into an
+    array of unsigned 32 bit GIDs; csv/array layers are returned as they are.
+    """
+    if raw.get('encoding', 'csv') != 'base64':
+        return raw['data']
+    buf = base64.b64decode(raw['data'])
+    compression = raw.get('compression', '')
+    if compression == 'zlib':
+        buf = zlib.decompress(buf)
+    elif compression == 'gzip':
+        buf = gzip.decompress(buf)
+    elif compression == 'zstd':
+        if zstandard is None:
+            print("FATAL: layer %s is zstd compressed but zstandard is not installed" % raw['name'])
+            exit(1)
+        buf = zstandard.ZstdDecompressor().decompressobj().decompress(buf)
+    elif compression != '':
+        print("FATAL: unsupported layer compression %s" % compression)
+        exit(1)
+    tiles = array('I')
+    if tiles.itemsize != 4:
+        tiles = array('L')
+    tiles.frombytes(buf)
+    if sys.byteorder == 'big':
+        tiles.byteswap()
+    return tiles
+
+
+def get_properties(raw):
+    """
+    Return the custom properties of a Tiled map, layer or object as a dict,
+    both from the old {name: value} format and from the list format of
+    newer Tiled versions.
+    """
+    properties = raw.get('properties', {})
+    if isinstance(properties, list):
+        return {prop['name']: prop['value'] for prop in properties}
+    return properties
+
+
+def c_values(values):
+    """
+    Format values as the body of a C array initializer
+    """
+    return ''.join(['%s, ' % value for value in values])
+
+
+def size_ctype(sizes):
+    """
+    Return the C type of size constants holding sizes, a byte unless one of
+    them does not fit
+    """
+    return 'unsigned int' if any(size > 255 for size in sizes) else 'unsigned char'
+
+
+def pack_bytes(values):
+    """
+    Pack values as an unsigned char C array would store them
+    """
+    return bytes([value & 0xff for value in values])
+
+
+def pack_words(values):
+    """
+    Pack values as an unsigned int C array would store them on the Z80
+    """
+    return struct.pack('<%dH' % len(values), *[value & 0xffff for value in values])
+
+
+def rle_decode(bufin, bits=0):
+    """
+    Reference decoder of the streams produced by TileLayer.compress_rle: a
+    positive count is followed by a value repeated count times, a negative
+    count by -count literal values. If bits is given counts are read as
+    signed values of that width, as the engine sees the emitted arrays.
+    """
+    bufout = []
+    idx = 0
+    while idx < len(bufin):
+        count = bufin[idx]
+        if bits and count >= 1 << (bits - 1):
+            count -= 1 << bits
+        if count > 0:
+            if idx + 1 >= len(bufin):
+                break  # truncated stream
+            bufout.extend([bufin[idx + 1]] * count)
+            idx += 2
+        else:
+            bufout.extend(bufin[idx + 1:idx + 1 - count])
+            idx += 1 - count
+    return bufout
+
+
+def lz_decode(bufin):
+    """
+    Reference decoder of the streams produced by TileLayer.compress_lz,
+    equivalent to map_inflate_lz: a token below 0x80 is followed by that many
+    literal values, a token above copies (token & 0x7f) + 3 values starting
+    offset values back, with the offset following as a little endian word.
+    A zero token ends the stream.
+    """
+    bufout = []
+    idx = 0
+    while idx < len(bufin):
+        token = bufin[idx]
+        if token == 0:
+            break
+        elif token < 0x80:
+            bufout.extend(bufin[idx + 1:idx + 1 + token])
+            idx += 1 + token
+        else:
+            if idx + 2 >= len(bufin):
+                break  # truncated stream
+            start = len(bufout) - (bufin[idx + 1] | bufin[idx + 2] << 8)
+            if start < 0:
+                break  # offset before the start of the stream
+            # copies may overlap the output, as ldir does
+            for pos in range(start, start + (token & 0x7f) + LZ_MIN_MATCH):
+                bufout.append(bufout[pos])
+            idx += 3
+    return bufout
+
+
+def block_decode(dict_tiles, bufin, w, h, block_w=2, block_h=2):
+    """
+    Reference decoder of block compression, equivalent to map_inflate for
+    2x2 blocks and to map_inflate_block for other sizes: dict_tiles is the
+    expanded dictionary and bufin the block indexes.
+    """
+    bufout = [0] * (w * h)
+    stride = block_w * block_h
+    idx = 0
+    for i in range(0, h, block_h):
+        for j in range(0, w, block_w):
+            block = dict_tiles[bufin[idx] * stride:bufin[idx] * stride + stride]
+            for y in range(0, block_h):
+                bufout[(i + y) * w + j:(i + y) * w + j + block_w] = block[y * block_w:(y + 1) * block_w]
+            idx += 1
+    return bufout
+
+
+def escape_block_indexes(indexes, block_dict):
+    """
+    Renumber the blocks by decreasing use, so the BLOCK_ESCAPE most used
+    ones get a one byte index and the rest are written as BLOCK_ESCAPE
+    followed by a little endian word. Return the stream and the renumbered
+    dictionary.
+    """
+    uses = [0] * len(block_dict)
+    for idx in indexes:
+        uses[idx] += 1
+    renumbered = BlockDictionary()
+    for idx in sorted(range(len(block_dict)), key=lambda idx: -uses[idx]):
+        renumbered.lookup(block_dict[idx])
+    stream = []
+    for idx in indexes:
+        new_idx = renumbered.lookup(block_dict[idx])
+        if new_idx < BLOCK_ESCAPE:
+            stream.append(new_idx)
+        else:
+            stream.extend((BLOCK_ESCAPE, new_idx & 0xff, new_idx >> 8))
+    return stream, renumbered
+
+
+def unescape_block_indexes(stream):
+    """
+    Reference decoder of escape_block_indexes, returns the block indexes
+    """
+    indexes = []
+    idx = 0
+    while idx < len(stream):
+        if stream[idx] == BLOCK_ESCAPE:
+            if idx + 2 >= len(stream):
+                break  # truncated stream
+            indexes.append(stream[idx + 1] | stream[idx + 2] << 8)
+            idx += 3
+        else:
+            indexes.append(stream[idx])
+            idx += 1
+    return indexes
+
+
+def split_block_regions(indexes, block_dict, row_blocks):
+    """
+    Split the block indexes of a map, row_blocks to a row of blocks, in
+    bands of whole rows using up to 256 distinct blocks each. Return the
+    first block row, the indexes and the dictionary of each band.
+    """
+    rows = len(indexes) // row_blocks
+    bounds = []
+    start = 0
+    used = set()
+    for row in range(rows):
+        row_used = set(indexes[row * row_blocks:(row + 1) * row_blocks])
+        if row > start and len(used | row_used) > 256:
+            bounds.append((start, row))
+            start = row
+            used = set()
+        used |= row_used
+    if rows > start:
+        bounds.append((start, rows))
+    regions = []
+    for start, end in bounds:
+        region_dict = BlockDictionary()
+        region = [region_dict.lookup(block_dict[idx]) for idx in indexes[start * row_blocks:end * row_blocks]]
+        regions.append((start, region, region_dict))
+    return regions
+
+
+def block_format_size(fmt, encoded):
+    """
+    Bytes taken by (indexes, dictionary) pairs encoded with a block index
+    format, excluding terminators
+    """
+    size = 0
+    for indexes, block_dict in encoded:
+        size += sum(len(block) for block in block_dict.blocks)
+        size += len(indexes) * (2 if fmt == BLOCK_INDEX_WIDE else 1)
+    return size
+
+
+def parse_scroll(value):
+    """
+    Parse the rl_scroll property, one of SCROLL_LAYOUTS or none
+    """
+    scroll = str(value).lower()
+    if scroll in ('', 'none'):
+        return None
+    if scroll not in SCROLL_LAYOUTS:
+        print("FATAL: rl_scroll must be one of none, %s" % ', '.join(SCROLL_LAYOUTS))
+        exit(1)
+    return scroll
+
+
+def tile_collision_classes(raw_map):
+    """
+    Return the collision class of the tiles of the embedded tilesets of a map
+    that set the rl_collision property, by GID
+    """
+    classes = {}
+    for tileset in raw_map.get('tilesets', []):
+        tiles = tileset.get('tiles', [])
+        if isinstance(tiles, dict):
+            tiles = [dict(tile, id=int(tile_id)) for tile_id, tile in tiles.items()]
+        tiles = tiles + [{'id': int(tile_id), 'properties': properties}
+                         for tile_id, properties in tileset.get('tileproperties', {}).items()]
+        for tile in tiles:
+            properties = get_properties(tile)
+            if 'rl_collision' not in properties:
+                continue
+            value = str(properties['rl_collision']).lower()
+            if value not in COLLISION_CLASSES:
+                print("FATAL: rl_collision must be one of %s" % ', '.join(COLLISION_CLASSES))
+                exit(1)
+            classes[tileset['firstgid'] + tile['id']] = COLLISION_CLASSES[value]
+    return classes
+
+
+def parse_tile_usage(value):
+    """
+    Parse the rl_tiles property, one of TILE_USAGES or none
+    """
+    usage = str(value).lower()
+    if usage in ('', 'none'):
+        return None
+    if usage not in TILE_USAGES:
+        print("FATAL: rl_tiles must be one of none, %s" % ', '.join(TILE_USAGES))
+        exit(1)
+    return usage
+
+
+def parse_block_size(value):
+    """
+    Parse a block size given as WxH, returning None if it is not one of
+    BLOCK_SIZES
+    """
+    try:
+        size = tuple(int(dim) for dim in str(value).lower().split('x'))
+    except ValueError:
+        return None
+    return size if size in BLOCK_SIZES else None
+
+
+def parse_object_grid(value, segment_size):
+    """
+    Parse the rl_obj_grid property, a cell size in tiles given as WxH,
+    segment to use the segment size, or none to leave the objects unindexed
+    """
+    grid = str(value).lower()
+    if grid in ('', 'none'):
+        return None
+    if grid == 'segment':
+        return segment_size
+    try:
+        size = tuple(int(dim) for dim in grid.split('x'))
+    except ValueError:
+        size = ()
+    if len(size) != 2 or min(size) < 1:
+        print("FATAL: rl_obj_grid must be WxH in tiles, segment or none")
+        exit(1)
+    return size
+
+
+class Z80CostModel:
+    """
+    Estimated cost in T-states of inflating tile layer data on a 3.58MHz Z80.
+
+    Block costs follow the loops of map_inflate, map_inflate_block and
+    __map_inflate_screen in engine/map.c as generated by SDCC, so they are estimates to compare modes
+    rather than exact timings. The engine has no decoder for the map RLE
+    streams yet, RLE costs assume a straightforward loop using ldir for
+    literals and ld (hl),a / inc hl / djnz for runs. LZ costs follow the
+    token loop of map_inflate_lz.
+    """
+    CLOCK = 3579545
+    FRAME = 59736           # 228 T-states x 262 lines at 60Hz
+    CALL = 150              # call, frame pointer setup and return
+    RAW_TILE = 21           # ldir
+    RLE_RUN = 90            # fetch count, test sign, set up the copy or fill
+    RLE_FILL_TILE = 24      # ld (hl),a ; inc hl ; djnz
+    RLE_COPY_TILE = 21      # ldir
+    BLOCK = 265             # map_inflate: index * 4 and four load/store pairs
+    BLOCK_ROW = 60          # map_inflate: end of row test and skip
+    SCREEN_BLOCK = 330      # __map_inflate_screen: 16 bit index, src/dst recomputed
+    SCREEN_ROW = 80
+    BLOCK_INDEX = 300       # map_inflate_block: index * block size, row pointer setup
+    BLOCK_LINE = 50         # map_inflate_block: next line of the block
+    BLOCK_TILE = 45         # map_inflate_block: load/store and loop
+    BLOCK_WIDE = 20         # map_inflate_block_wide: read the high byte of the index
+    BLOCK_ESCAPE_TEST = 15  # map_inflate_block_escape: compare with the escape byte
+    BLOCK_ESCAPE = 40       # map_inflate_block_escape: read an escaped index
+    LZ_LITERAL = 57         # fetch and test the token, set up ldir
+    LZ_MATCH = 194          # as above plus read the offset and compute the source
+    LZ_COPY_TILE = 21       # ldir
+    SCREEN_W = 32
+    SCREEN_H = 24
+
+    def frames(self, tstates):
+        return tstates / self.FRAME
+
+    def raw(self, tiles):
+        return self.CALL + self.RAW_TILE * tiles
+
+    def rle(self, bufin):
+        cost = self.CALL
+        idx = 0
+        while idx < len(bufin):
+            count = bufin[idx]
+            if count > 0:
+                cost += self.RLE_RUN + self.RLE_FILL_TILE * count
+                idx += 2
+            else:
+                cost += self.RLE_RUN + self.RLE_COPY_TILE * -count
+                idx += 1 - count
+        return cost
+
+    def lz(self, bufin):
+        cost = self.CALL
+        idx = 0
+        while idx < len(bufin):
+            token = bufin[idx]
+            if token < 0x80:
+                cost += self.LZ_LITERAL + self.LZ_COPY_TILE * token
+                idx += 1 + token
+            else:
+                cost += self.LZ_MATCH + self.LZ_COPY_TILE * ((token & 0x7f) + LZ_MIN_MATCH)
+                idx += 3
+        return cost
+
+    def blocks(self, w, h, block_w=2, block_h=2):
+        count = (w // block_w) * (h // block_h)
+        if (block_w, block_h) == (2, 2):
+            return self.CALL + self.BLOCK * count + self.BLOCK_ROW * (h // 2)
+        return self.CALL + (self.BLOCK_INDEX + self.BLOCK_LINE * block_h + self.BLOCK_TILE * block_w * block_h) * \
+            count + self.BLOCK_ROW * (h // block_h)
+
+    def block_indexes(self, fmt, data):
+        """
+        Extra cost of reading block indexes stored in a format other than
+        one byte per block
+        """
+        if fmt == BLOCK_INDEX_WIDE:
+            return self.BLOCK_WIDE * len(data)
+        elif fmt == BLOCK_INDEX_ESCAPE:
+            count = len(unescape_block_indexes(data))
+            return self.BLOCK_ESCAPE_TEST * count + self.BLOCK_ESCAPE * (len(data) - count) // 2
+        return 0
+
+    def screen_blocks(self):
+        return self.CALL + self.SCREEN_BLOCK * (self.SCREEN_W // 2) * (self.SCREEN_H // 2) + \
+            self.SCREEN_ROW * (self.SCREEN_H // 2)
+
 
 class MapObject:
     """
@@ -46,12 +517,195 @@ class MapObject:
         print("\tmapobject : [%s] [%s] [%s] (%s, %s)" % (self.id, self.name, self.type, self.x, self.y))
 
 
+class ObjectSchema:
+    """
+    Registry of the object types of a map, built in a single pass as the
+    objects of every layer are read.
+
+    types holds the properties of every type in the order they are first
+    seen, enums the values of the properties that take names and ranges the
+    (min, max) of every field of every type, as the values are emitted.
+    """
+
+    FIELDS = ('x', 'y', 'w', 'h', 'visible')
+
+    def __init__(self):
+        self.types = {}
+        self.enums = {}
+        self.ranges = {}
+
+    @staticmethod
+    def object_type(item):
+        _type = item['type']
+        if _type == '':
+            _type = item['name']
+        return _type
+
+    @staticmethod
+    def properties(item):
+        return {_property: str(value) for _property, value in get_properties(item).items()}
+
+    def fields(self, _type):
+        return self.FIELDS + tuple(self.types[_type])
+
+    def is_enum(self, _property, value):
+        return value in self.enums.get(_property, ())
+
+    def add(self, item):
+        """
+        Register an object, its type, properties and the values they take
+        """
+        _type = self.object_type(item)
+        properties = self.properties(item)
+        seen = _type in self.types
+        if not seen:
+            self.types[_type] = []
+            self.ranges[_type] = dict.fromkeys(self.FIELDS)
+        ranges = self.ranges[_type]
+        for _property, value in properties.items():
+            if _property not in ranges:
+                self.types[_type].append(_property)
+                # objects of the type seen before take the default 0
+                ranges[_property] = (0, 0) if seen else None
+            if not value.isdigit() and not value.replace('.', '').isdigit():
+                values = self.enums.setdefault(_property, {})
+                if value not in values:
+                    values[value] = len(values)
+        for field, value in zip(self.fields(_type), self.values(item, properties)[1]):
+            low, high = ranges.get(field) or (value, value)
+            ranges[field] = (min(low, value), max(high, value))
+
+    def values(self, item, properties=None):
+        """
+        Return the type of an object and the values of its fields, as they
+        are emitted unpacked with names replaced by their enum values
+        """
+        _type = self.object_type(item)
+        if properties is None:
+            properties = self.properties(item)
+        values = [int(item['x'] % 256), int(item['y'] % 176), int(item['width']) % 256,
+                  int(item['height']) % 256, 1 if item['visible'] else 0]
+        for _property in self.types[_type]:
+            value = properties.get(_property, "0")
+            if self.is_enum(_property, value):
+                values.append(self.enums[_property][value])
+            else:
+                values.append(int(value.replace('.', '')) % 256)
+        return _type, values
+
+
+class ObjectPacking:
+    """
+    Bit packed layout of map objects.
+
+    Every field gets the bits needed by its largest value across all the
+    objects of a type, fields that are always 0 take none. Records start
+    with the type and are padded to whole bytes, a byte with all the type
+    bits set ends a list of objects as 255 does for unpacked objects.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.types = list(schema.types)
+        self.type_bits = max(len(self.types).bit_length(), 1)
+        self.widths = {_type: {field: high.bit_length() for field, (low, high) in schema.ranges[_type].items()}
+                       for _type in self.types}
+
+    def layout(self, _type):
+        """
+        Return the (field, bit, width) of every field of a type, the type
+        itself taking the first type_bits bits
+        """
+        layout = []
+        bit = self.type_bits
+        for field in self.schema.fields(_type):
+            width = self.widths[_type][field]
+            layout.append((field, bit, width))
+            bit += width
+        return layout
+
+    def record_size(self, _type):
+        field, bit, width = self.layout(_type)[-1]
+        return (bit + width + 7) // 8
+
+    def pack(self, item):
+        """
+        Return the packed record of an object as a list of bytes
+        """
+        _type, values = self.schema.values(item)
+        record = self.types.index(_type)
+        for (field, bit, width), value in zip(self.layout(_type), values):
+            record |= value << bit
+        return list(record.to_bytes(self.record_size(_type), 'little'))
+
+    def dump_accessors(self, file, basename):
+        """
+        Dump the C macros reading the fields of packed records, fields are at
+        most 8 bits wide so they span at most two bytes
+        """
+        print(("#define %s_OBJECT_PACKED 1" % basename.upper()), file=file)
+        print(("#define %s_OBJECT_TYPE_BITS %s" % (basename.upper(), self.type_bits)), file=file)
+        print(("#define %s_object_bits(p, bit, width) ((unsigned char)((((p)[(bit) >> 3] | "
+               "((unsigned int)(p)[((bit) >> 3) + 1] << 8)) >> ((bit) & 7)) & ((1 << (width)) - 1)))" % basename),
+              file=file)
+        print(("#define %s_object_type(p) ((p)[0] & %s)" % (basename, (1 << self.type_bits) - 1)), file=file)
+        for _type in self.types:
+            print(("#define %s_OBJECT_%s_SIZE %s" % (basename.upper(), _type.upper(), self.record_size(_type))),
+                  file=file)
+            for field, bit, width in self.layout(_type):
+                if field == 'static':
+                    field = 'static_'
+                if width == 0:
+                    print(("#define %s_object_%s_%s(p) 0" % (basename, _type, field)), file=file)
+                else:
+                    print(("#define %s_object_%s_%s(p) %s_object_bits(p, %s, %s)" % (
+                        basename, _type, field, basename, bit, width)), file=file)
+
+
+class BlockDictionary:
+    """
+    Dictionary of tile blocks used by block compression.
+
+    Blocks are kept in insertion order, so the index of a block is its
+    position in the emitted table, and can be looked up both ways in O(1).
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        return self.blocks[idx]
+
+    def lookup(self, block):
+        """
+        Return the index of block, adding it to the dictionary if needed
+        """
+        key = tuple(block)
+        idx = self.index.get(key)
+        if idx is None:
+            idx = len(self.blocks)
+            self.index[key] = idx
+            self.blocks.append(key)
+        return idx
+
+    def expand(self):
+        """
+        Return the flat list of tiles of all blocks, in index order
+        """
+        return [tile for block in self.blocks for tile in block]
+
+
 class TileLayer:
     """
     Contains a Tiled layer that contains tiles
     """
 
-    def __init__(self, raw, seg_w, seg_h, compr, segment):
+    def __init__(self, raw, seg_w, seg_h, compr, segment, budget=None, block_size=(2, 2), dict_cap=256,
+                 scroll=None, tiles=None, previous=None):
         self.w = raw['width']
         self.h = raw['height']
         self.x = raw['x']
@@ -59,55 +713,469 @@ class TileLayer:
         self.name = raw['name']
         self.opacity = raw['opacity']
         self.visible = raw['visible']
-        self.data = raw['data']
+        self.data = decode_layer_data(raw)
         self.seg_h = seg_h
         self.seg_w = seg_w
-        self.compr = compr
         self.segment = segment
+        self.budget = budget
+        self.block_w, self.block_h = block_size
+        self.dict_cap = dict_cap
+        self.mode_reasons = []
+        self.room_reuse = {}
+        self.reused_layer = False
+        self.reused_rooms = 0
+        properties = get_properties(raw)
+        if 'rl_compr' in properties:
+            compr = str(properties['rl_compr']).lower()
+            if compr not in COMPRESSORS and compr != 'auto':
+                compr = None
+        if 'rl_scroll' in properties:
+            scroll = parse_scroll(properties['rl_scroll'])
+        if 'rl_tiles' in properties:
+            tiles = parse_tile_usage(properties['rl_tiles'])
+        self.compr = compr
+        self.scroll = scroll
+        self.tiles = tiles
+        self.patterns = None
+        if self.tiles == 'remap':
+            self.remap_tiles()
+        if previous is not None:
+            self.inherit(previous)
+        if self.compr == 'auto':
+            self.mode = self.select_mode()
+        else:
+            self.mode = self.compr_mode(self.compr)
+
+    def compr_mode(self, compr):
         if not self.segment:
-            if self.compr == 'rle':
-                self.mode = 1
-            elif self.compr == 'block':
-                self.mode = 2
+            if compr == 'rle':
+                return 1
+            elif compr in ('block', 'shared'):
+                # a whole map block dictionary is already shared
+                return 2
+            elif compr == 'lz':
+                return 6
+            else:
+                return 0
+        else:
+            if compr == 'rle':
+                return 3
+            elif compr == 'block':
+                return 4
+            elif compr == 'lz':
+                return 7
+            elif compr == 'shared':
+                return 8
             else:
-                self.mode = 0
+                return 5
+
+    def select_mode(self):
+        """
+        Pick the smallest encoding that decodes back correctly and, if a
+        budget in frames is set, whose screen decode time fits in it. When
+        nothing fits the budget the fastest valid encoding is used. The
+        reasoning is kept in mode_reasons. Segmented layers are never left
+        raw, as raw layers have no per segment data.
+        """
+        model = Z80CostModel()
+        candidates = []
+        for compr in COMPRESSORS if self.segment else COMPRESSORS + (None,):
+            self.mode = self.compr_mode(compr)
+            if not self.blocks_fit():
+                candidates.append((self.mode, None, None, 'size not a multiple of the block size'))
+                continue
+            if self.mode == 8 and not self.shared_fits():
+                candidates.append((self.mode, None, None, 'segment dictionary over %s blocks' % self.dict_cap))
+                continue
+            size = sum(len(data) for symbol, ctype, data in self.binary_payloads(''))
+            full, screen = self.decode_cost(model)
+            frames = model.frames(screen)
+            problem = None
+            if size > 8192:
+                problem = 'bigger than 8k'
+            elif not self.verify():
+                problem = 'does not decode back'
+            candidates.append((self.mode, size, frames, problem))
+        valid = [cand for cand in candidates if cand[3] is None]
+        fitting = [cand for cand in valid if self.budget is None or cand[2] <= self.budget]
+        if fitting:
+            mode = min(fitting, key=lambda cand: (cand[1], cand[2]))[0]
+        elif valid:
+            mode = min(valid, key=lambda cand: (cand[2], cand[1]))[0]
         else:
-            if self.compr == 'rle':
-                self.mode = 3
-            elif self.compr == 'block':
-                self.mode = 4
+            mode = None
+        for cand_mode, size, frames, problem in candidates:
+            if size is None:
+                self.mode_reasons.append("%s: %s" % (MODE_NAMES[cand_mode], problem))
+                continue
+            if problem:
+                note = problem
+            elif cand_mode == mode:
+                note = 'selected' if fitting else 'selected, fastest but over budget'
+            elif self.budget is not None and frames > self.budget:
+                note = 'over budget'
             else:
-                self.mode = 5
-        self.compress_all()
+                note = 'larger'
+            self.mode_reasons.append("%s: %d bytes, %.2f frames per screen, %s" %
+                                     (MODE_NAMES[cand_mode], size, frames, note))
+        if mode is None:
+            print("FATAL: no encoding fits tile layer %s" % self.name)
+            for reason in self.mode_reasons:
+                print("  %s" % reason)
+            exit(1)
+        return mode
+
+    def inherit(self, previous):
+        """
+        Reuse the encodings computed by a previous version of the layer: all
+        of them if its tiles did not change, otherwise those of the segments
+        that did not change. Encodings do not depend on the mode, only on the
+        tiles and the geometry, but the tile usage also depends on segment
+        and tiles.
+        """
+        settings = ('w', 'h', 'seg_w', 'seg_h', 'block_w', 'block_h', 'dict_cap', 'scroll', 'segment', 'tiles')
+        if any(getattr(self, name) != getattr(previous, name) for name in settings):
+            return
+        computed = previous.__dict__
+        if self.data == previous.data:
+            for name, attr in vars(TileLayer).items():
+                if isinstance(attr, cached_property) and name in computed:
+                    self.__dict__[name] = computed[name]
+            self.reused_layer = True
+            return
+        if 'data_rooms' not in computed:
+            return
+        if 'data_rooms_rle' in computed:
+            for room, room_data in zip(computed['data_rooms'], computed['data_rooms_rle']):
+                self.room_reuse[('rle', tuple(room))] = room_data
+        if 'data_rooms_lz' in computed:
+            for room, room_data in zip(computed['data_rooms'], computed['data_rooms_lz']):
+                self.room_reuse[('lz', tuple(room))] = room_data
+        if 'rooms_compr_4x4' in computed:
+            for room, room_data in zip(computed['data_rooms'], zip(*computed['rooms_compr_4x4'])):
+                self.room_reuse[('block', tuple(room))] = room_data
+
+    def room_encoding(self, kind, room, encode):
+        """
+        Return encode(room), unless inherited from a previous version of the
+        layer
+        """
+        encoded = self.room_reuse.get((kind, tuple(room)))
+        if encoded is None:
+            return encode(room)
+        self.reused_rooms += 1
+        return encoded
+
+    def remap_tiles(self):
+        """
+        Renumber the tiles used by the layer densely, keeping their order.
+        patterns holds the tile each new number replaces, so only the
+        patterns of used tiles need to be uploaded, next to each other.
+        """
+        self.patterns = sorted(set(self.data))
+        if len(self.patterns) > 256:
+            print("FATAL: tile layer %s uses %s tiles, more than the 256 a remap can number" %
+                  (self.name, len(self.patterns)))
+            exit(1)
+        numbers = {tile: number for number, tile in enumerate(self.patterns)}
+        self.data = [numbers[tile] for tile in self.data]
+
+    @cached_property
+    def tile_usage(self):
+        """
+        Tiles used by the layer and by each of its segments, as emitted
+        """
+        used = sorted(set(self.data))
+        segments = []
+        if self.segment:
+            segments = [sorted(set(room)) for room in self.data_rooms]
+        return used, segments
+
+    def tile_usage_tables(self, basename):
+        """
+        Return the (symbol, type, values) tables of the tile usage analysis:
+        the used tiles, the tiles used by each segment with the offset of
+        each segment into them, and the remapped patterns. Tiles are bytes
+        unless the layer uses tiles above 255.
+        """
+        if not self.tiles:
+            return []
+        used, segments = self.tile_usage
+        name = '%s_%s' % (basename, self.name)
+        ctype = 'unsigned char' if not used or used[-1] < 256 else 'unsigned int'
+        tables = [(name + '_tiles', ctype, used)]
+        if segments:
+            offsets = [0]
+            for segment_tiles in segments:
+                offsets.append(offsets[-1] + len(segment_tiles))
+            tables.append((name + '_segment_tiles', ctype,
+                           [tile for segment_tiles in segments for tile in segment_tiles]))
+            tables.append((name + '_segment_tiles_offset', 'unsigned int', offsets))
+        if self.patterns is not None:
+            ctype = 'unsigned char' if not self.patterns or self.patterns[-1] < 256 else 'unsigned int'
+            tables.append((name + '_patterns', ctype, self.patterns))
+        return tables
+
+    def tile_usage_payloads(self, basename):
+        return [(symbol, ctype, pack_bytes(values) if ctype == 'unsigned char' else pack_words(values))
+                for symbol, ctype, values in self.tile_usage_tables(basename)]
+
+    def dump_tile_usage(self, file, basename):
+        total_size = 0
+        for symbol, ctype, values in self.tile_usage_tables(basename):
+            print(("const %s %s[] = {" % (ctype, symbol)), end=' ', file=file)
+            total_size += len(values) * (1 if ctype == 'unsigned char' else 2)
+            file.write(c_values(values))
+            print("};", file=file)
+        return total_size
+
+    def blocks_fit(self):
+        """
+        Check that block modes split the map, or each segment, in whole blocks
+        """
+        if self.mode == 2:
+            return self.w % self.block_w == 0 and self.h % self.block_h == 0
+        elif self.mode in (4, 8):
+            return self.seg_w % self.block_w == 0 and self.seg_h % self.block_h == 0
+        return True
+
+    def shared_fits(self):
+        """
+        Check that every segment uses few enough blocks to fit in a bank of
+        the shared dictionary
+        """
+        return all(len(set(room_data)) <= self.dict_cap for room_data in self.rooms_shared_4x4[0])
 
     def compress_all(self):
+        """
+        Force every encoding of the layer. Encodings are otherwise computed
+        lazily the first time they are accessed and cached, so the header
+        generation only pays for the one selected by the mode.
+        """
+        self.data_rle
+        self.data_rooms_rle
+        if self.w % self.block_w == 0 and self.h % self.block_h == 0:
+            self.data_compr_4x4
+        if self.seg_w % self.block_w == 0 and self.seg_h % self.block_h == 0:
+            self.data_rooms_compr_4x4
+            if self.shared_fits():
+                self.rooms_shared_blocks
+        self.data_lz
+        self.data_rooms_lz
+
+    @cached_property
+    def data_rle(self):
         # Compress RLE the whole map (cmpr ratio ~2)
-        self.data_rle = self.compress_rle(self.data)
+        return self.compress_rle(self.data)
 
-        # Split in rooms and compress each RLE (compr ratio ~2)
-        self.data_rooms = self.room_split(self.data, self.seg_w, self.seg_h)
-        self.data_rooms_rle = []
-        for room in self.data_rooms:
-            self.data_rooms_rle.append(self.compress_rle(room))
+    @cached_property
+    def data_rooms(self):
+        return self.room_split(self.data, self.seg_w, self.seg_h)
 
+    @cached_property
+    def data_rooms_rle(self):
+        # Split in rooms and compress each RLE (compr ratio ~2)
+        #   segments are emitted as unsigned char, keep counts within a signed char
+        return [self.room_encoding('rle', room, lambda room: self.compress_rle(room, 127, 128))
+                for room in self.data_rooms]
+
+    @cached_property
+    def data_lz(self):
+        # Compress LZ the whole map, tiles are emitted as unsigned char
+        return self.compress_lz([tile & 0xff for tile in self.data])
+
+    @cached_property
+    def data_rooms_lz(self):
+        # Split in rooms and compress each LZ, matches stay within the room
+        return [self.room_encoding('lz', room, lambda room: self.compress_lz([tile & 0xff for tile in room]))
+                for room in self.data_rooms]
+
+    @cached_property
+    def compr_4x4(self):
         # Compress the whole map using 4x4 blocks (compr ratio ~2 to 4)
         #   note: if the dictionary is bigger than 255 compression drops 50% because we need
         #   one additional byte to store each block
-        self.block_dict = {}
-        self.data_compr_4x4 = self.compress_4x4_dict(self.data, self.w, self.h)
-        self.data_compr_4x4_dict = self.block_dict
+        block_dict = BlockDictionary()
+        data = self.compress_4x4_dict(self.data, self.w, self.h, block_dict)
+        return data, block_dict
+
+    @property
+    def data_compr_4x4(self):
+        return self.compr_4x4[0]
+
+    @property
+    def data_compr_4x4_dict(self):
+        return self.compr_4x4[1]
 
+    @cached_property
+    def rooms_compr_4x4(self):
         # Split in rooms and compress each using 4x4 blocks
         #   in most cases this is the most efficient compression, with compr ratio of ~4
         #   regardless of the size of the whole map.
-        self.data_rooms_compr_4x4 = []
-        self.data_rooms_compr_4x4_dict = []
+        rooms = []
+        dicts = []
         for block in self.data_rooms:
-            self.block_dict = {}
-            self.data_rooms_compr_4x4.append(self.compress_4x4_dict(block, self.seg_w, self.seg_h))
-            self.data_rooms_compr_4x4_dict.append(self.block_dict)
+            room_data, block_dict = self.room_encoding('block', block, self.compress_room_4x4)
+            rooms.append(room_data)
+            dicts.append(block_dict)
+        return rooms, dicts
+
+    def compress_room_4x4(self, room):
+        block_dict = BlockDictionary()
+        return self.compress_4x4_dict(room, self.seg_w, self.seg_h, block_dict), block_dict
+
+    @property
+    def data_rooms_compr_4x4(self):
+        return self.rooms_compr_4x4[0]
+
+    @property
+    def data_rooms_compr_4x4_dict(self):
+        return self.rooms_compr_4x4[1]
+
+    @cached_property
+    def scroll_strips(self):
+        """
+        Strips of the layer for scrolling, in the layouts asked by rl_scroll:
+        maps 'column' and 'row' to the strip tiles and the offset of each
+        column or row into them. Identical strips are stored once.
+        """
+        strips = {}
+        for kind in SCROLL_LAYOUTS.get(self.scroll, ()):
+            if kind == 'column':
+                lines = [[self.data[y * self.w + x] & 0xff for y in range(self.h)] for x in range(self.w)]
+            else:
+                lines = [[tile & 0xff for tile in self.data[y * self.w:(y + 1) * self.w]] for y in range(self.h)]
+            tiles = []
+            offsets = []
+            seen = {}
+            for line in lines:
+                offset = seen.get(tuple(line))
+                if offset is None:
+                    offset = seen[tuple(line)] = len(tiles)
+                    tiles.extend(line)
+                offsets.append(offset)
+            strips[kind] = (tiles, offsets)
+        return strips
+
+    def scroll_payloads(self, basename):
+        """
+        Return the (symbol, type, data) payloads of the scroll strips and
+        their offset tables, as binary_payloads does for the layer data
+        """
+        payloads = []
+        for kind, (tiles, offsets) in self.scroll_strips.items():
+            name = '%s_%s_%ss' % (basename, self.name, kind)
+            payloads.append((name, 'unsigned char', pack_bytes(tiles)))
+            payloads.append(('%s_%s_%s_offset' % (basename, self.name, kind), 'unsigned int', pack_words(offsets)))
+        return payloads
+
+    def dump_scroll_strips(self, file, basename):
+        total_size = 0
+        for kind, (tiles, offsets) in self.scroll_strips.items():
+            print(("const unsigned char %s_%s_%ss[] = {" % (basename, self.name, kind)), end=' ', file=file)
+            total_size += len(tiles)
+            file.write(c_values(tiles))
+            print("};", file=file)
+            print(("const unsigned int %s_%s_%s_offset[] = {" % (basename, self.name, kind)), end=' ', file=file)
+            total_size += len(offsets) * 2
+            file.write(c_values(offsets))
+            print("};", file=file)
+        return total_size
+
+    @cached_property
+    def rooms_shared_4x4(self):
+        # Split in rooms and compress all of them with a single dictionary
+        block_dict = BlockDictionary()
+        rooms = [self.compress_4x4_dict(room, self.seg_w, self.seg_h, block_dict) for room in self.data_rooms]
+        return rooms, block_dict
+
+    @cached_property
+    def rooms_shared_blocks(self):
+        """
+        Segments compressed with a dictionary shared by all of them, split in
+        banks of up to dict_cap blocks that hold whole consecutive segments.
+        Returns the bank dictionaries, the (bank, indexes) of each segment and
+        for each segment the first identical one, that is emitted in its place.
+        """
+        rooms, block_dict = self.rooms_shared_4x4
+        if not self.shared_fits():
+            print("FATAL: a segment uses more than %s blocks" % self.dict_cap)
+            exit(1)
+        first = {}
+        aliases = [first.setdefault(tuple(room_data), room_cnt) for room_cnt, room_data in enumerate(rooms)]
+        bank_rooms = []
+        used = set()
+        for room_cnt, room_data in enumerate(rooms):
+            if aliases[room_cnt] != room_cnt:
+                continue
+            room_used = set(room_data)
+            if not bank_rooms or len(used | room_used) > self.dict_cap:
+                bank_rooms.append([])
+                used = set()
+            bank_rooms[-1].append(room_cnt)
+            used |= room_used
+        banks = []
+        segments = [None] * len(rooms)
+        for bank, room_cnts in enumerate(bank_rooms):
+            bank_dict = BlockDictionary()
+            for room_cnt in room_cnts:
+                segments[room_cnt] = (bank, [bank_dict.lookup(block_dict[idx]) for idx in rooms[room_cnt]])
+            banks.append(bank_dict)
+        for room_cnt, alias in enumerate(aliases):
+            segments[room_cnt] = segments[alias]
+        return banks, segments, aliases
+
+    @cached_property
+    def compr_blocks(self):
+        """
+        Block compression of the whole map in the smallest index format for
+        its dictionary: returns the format and the (first tile row, indexes,
+        dictionary) of each region, a single one unless split in regions.
+        """
+        data, block_dict = self.compr_4x4
+        if len(block_dict) <= 256:
+            return BLOCK_INDEX_BYTE, [(0, data, block_dict)]
+        stream, renumbered = escape_block_indexes(data, block_dict)
+        regions = split_block_regions(data, block_dict, self.w // self.block_w)
+        candidates = [(BLOCK_INDEX_WIDE, [(0, data, block_dict)]),
+                      (BLOCK_INDEX_ESCAPE, [(0, stream, renumbered)]),
+                      (BLOCK_INDEX_REGIONS, [(row * self.block_h, region, region_dict)
+                                             for row, region, region_dict in regions])]
+        return min(candidates, key=lambda cand: block_format_size(
+            cand[0], [(indexes, region_dict) for row, indexes, region_dict in cand[1]]))
+
+    @cached_property
+    def rooms_compr_blocks(self):
+        """
+        Block compression of each segment, all of them in the smallest index
+        format for the biggest segment dictionary: returns the format and the
+        (indexes, dictionary) of each segment.
+        """
+        rooms = list(zip(*self.rooms_compr_4x4))
+        if all(len(room_dict) <= 256 for room_data, room_dict in rooms):
+            return BLOCK_INDEX_BYTE, rooms
+        candidates = [(BLOCK_INDEX_WIDE, rooms),
+                      (BLOCK_INDEX_ESCAPE, [escape_block_indexes(room_data, room_dict)
+                                            for room_data, room_dict in rooms])]
+        return min(candidates, key=lambda cand: block_format_size(*cand))
+
+    def block_indexes(self, fmt, data):
+        """
+        Read back the block indexes of an encoded stream, as wrapped by the
+        emitted C arrays
+        """
+        if fmt == BLOCK_INDEX_WIDE:
+            return [idx & 0xffff for idx in data]
+        elif fmt == BLOCK_INDEX_ESCAPE:
+            return unescape_block_indexes([idx & 0xff for idx in data])
+        return [idx & 0xff for idx in data]
+
+    def block_ctype(self, fmt):
+        return 'unsigned int' if fmt == BLOCK_INDEX_WIDE else 'unsigned char'
 
     def room_split(self, buf_in, w, h):
+        if numpy is not None:
+            return self.room_split_array(buf_in, w, h)
         buf_out = []
         for by in range(0, int(self.h / h)):
             for bx in range(0, int(self.w / w)):
@@ -119,7 +1187,74 @@ class TileLayer:
                 buf_out.append(block)
         return buf_out
 
-    def compress_rle(self, bufin):
+    def room_split_array(self, buf_in, w, h):
+        """
+        NumPy version of room_split: the layer is reshaped into a
+        (rooms_y, h, rooms_x, w) view and each room flattened in a single pass.
+        """
+        rooms_x = int(self.w / w)
+        rooms_y = int(self.h / h)
+        layer = numpy.asarray(buf_in, dtype=numpy.int64).reshape(self.h, self.w)
+        rooms = layer[:rooms_y * h, :rooms_x * w].reshape(rooms_y, h, rooms_x, w)
+        return rooms.swapaxes(1, 2).reshape(rooms_y * rooms_x, w * h).tolist()
+
+    def compress_rle(self, bufin, max_run=255, max_literal=255):
+        """
+        Optimal RLE encoder, producing the same stream format as the greedy
+        compress_rle_greedy: a positive count followed by the value to repeat
+        or a negative count followed by the literal values.
+
+        cost[i] is the minimum size of a stream encoding bufin[:i], the last
+        token ends at i and starts at j:
+            run:     cost[j] + 2          bufin[j:i] equal, i - j <= max_run
+            literal: cost[j] + 1 + i - j  i - j <= max_literal
+        Both windows of j only move forward, so their minimums are kept in
+        monotonic deques and the whole parse is linear.
+        """
+        size = len(bufin)
+        cost = [0] * (size + 1)
+        back = [0] * (size + 1)
+        literals = deque()  # j ordered by increasing cost[j] - j
+        runs = deque()      # j ordered by increasing cost[j]
+        run_start = 0
+        for i in range(1, size + 1):
+            j = i - 1
+            if j > 0 and bufin[j] != bufin[j - 1]:
+                run_start = j
+            while literals and cost[literals[-1]] - literals[-1] >= cost[j] - j:
+                literals.pop()
+            literals.append(j)
+            while literals[0] < i - max_literal:
+                literals.popleft()
+            while runs and cost[runs[-1]] >= cost[j]:
+                runs.pop()
+            runs.append(j)
+            while runs[0] < max(run_start, i - max_run):
+                runs.popleft()
+            lit = literals[0]
+            run = runs[0]
+            if cost[run] + 2 <= cost[lit] + 1 + i - lit:
+                cost[i] = cost[run] + 2
+                back[i] = run - i  # negative marks a run
+            else:
+                cost[i] = cost[lit] + 1 + i - lit
+                back[i] = i - lit
+        tokens = []
+        i = size
+        while i > 0:
+            if back[i] < 0:
+                j = i + back[i]
+                tokens.append([i - j, bufin[j]])
+            else:
+                j = i - back[i]
+                tokens.append([j - i] + list(bufin[j:i]))
+            i = j
+        bufout = []
+        for token in reversed(tokens):
+            bufout.extend(token)
+        return bufout
+
+    def compress_rle_greedy(self, bufin):
         cnt = 0
         size = len(bufin)
         bufout = []
@@ -145,36 +1280,270 @@ class TileLayer:
             cnt = idx
         return bufout
 
-    def lookup_4x4_dict(self, block):
-        key = str(block[0]) + '_' + str(block[1]) + '_' + str(block[2]) + '_' + str(block[3])
-        if key in self.block_dict:
-            return self.block_dict[key]
-        else:
-            new_idx = len(self.block_dict) + 1
-            self.block_dict[key] = new_idx
-            return new_idx
+    def lz_matches(self, bufin):
+        """
+        Return the length and offset of the longest match at each position
+        of bufin, found through hash chains of the positions where each
+        LZ_MIN_MATCH values prefix was seen, most recent first.
+        """
+        size = len(bufin)
+        lengths = [0] * size
+        offsets = [0] * size
+        chains = {}
+        for j in range(size - LZ_MIN_MATCH + 1):
+            chain = chains.setdefault(tuple(bufin[j:j + LZ_MIN_MATCH]), [])
+            limit = min(LZ_MAX_MATCH, size - j)
+            for k in reversed(chain[-LZ_CHAIN:]):
+                if j - k > LZ_WINDOW:
+                    break
+                length = LZ_MIN_MATCH
+                while length < limit and bufin[k + length] == bufin[j + length]:
+                    length += 1
+                if length > lengths[j]:
+                    lengths[j] = length
+                    offsets[j] = j - k
+                    if length == limit:
+                        break
+            chain.append(j)
+        return lengths, offsets
+
+    def compress_lz(self, bufin):
+        """
+        Optimal LZ encoder with a byte aligned format that inflates with ldir:
+            0x01-0x7f  token literal values follow
+            0x80-0xff  copy (token & 0x7f) + 3 values from offset values back,
+                       the offset follows as a little endian word
+            0x00       end of stream, the terminator of the emitted arrays
+
+        Matches may overlap the output, so a run is a match with offset 1.
+        cost[i] is the minimum size of a stream encoding bufin[:i], the last
+        token ends at i and starts at j:
+            literal: cost[j] + 1 + i - j  i - j <= LZ_MAX_LITERAL
+            match:   cost[j] + 3          i - j <= longest match at j
+        The literal window is kept in a monotonic deque as in compress_rle,
+        the matches still reaching i in a heap.
+        """
+        size = len(bufin)
+        lengths, offsets = self.lz_matches(bufin)
+        cost = [0] * (size + 1)
+        back = [0] * (size + 1)
+        literals = deque()  # j ordered by increasing cost[j] - j
+        matches = []        # (cost[j] + 3, j) of matches starting at j
+        for i in range(1, size + 1):
+            j = i - 1
+            while literals and cost[literals[-1]] - literals[-1] >= cost[j] - j:
+                literals.pop()
+            literals.append(j)
+            while literals[0] < i - LZ_MAX_LITERAL:
+                literals.popleft()
+            j = i - LZ_MIN_MATCH
+            if j >= 0 and lengths[j]:
+                heapq.heappush(matches, (cost[j] + 3, j))
+            while matches and matches[0][1] + lengths[matches[0][1]] < i:
+                heapq.heappop(matches)
+            lit = literals[0]
+            cost[i] = cost[lit] + 1 + i - lit
+            back[i] = i - lit
+            if matches and matches[0][0] < cost[i]:
+                cost[i], j = matches[0]
+                back[i] = j - i  # negative marks a match
+        tokens = []
+        i = size
+        while i > 0:
+            if back[i] < 0:
+                j = i + back[i]
+                tokens.append([0x80 | (i - j - LZ_MIN_MATCH), offsets[j] & 0xff, offsets[j] >> 8])
+            else:
+                j = i - back[i]
+                tokens.append([i - j] + list(bufin[j:i]))
+            i = j
+        bufout = []
+        for token in reversed(tokens):
+            bufout.extend(token)
+        return bufout
 
-    def compress_4x4_dict(self, buf, w, h):
+    def compress_4x4_dict(self, buf, w, h, block_dict):
+        """
+        Replace each block_w x block_h block of buf by its index in
+        block_dict, blocks are stored row by row
+        """
+        if w % self.block_w or h % self.block_h:
+            print("FATAL: map size %sx%s is not a multiple of the %sx%s block size" %
+                  (w, h, self.block_w, self.block_h))
+            exit(1)
+        if numpy is not None:
+            return self.compress_4x4_dict_array(buf, w, h, block_dict)
         bufout = []
-        for i in range(0, h, 2):
-            for j in range(0, w, 2):
-                block = [buf[i * w + j], buf[i * w + j + 1],
-                         buf[(i + 1) * w + j], buf[(i + 1) * w + j + 1]]
-                bufout.append(self.lookup_4x4_dict(block) - 1)  # need to adjust to zero
+        for i in range(0, h, self.block_h):
+            for j in range(0, w, self.block_w):
+                block = []
+                for y in range(i, i + self.block_h):
+                    block.extend(buf[y * w + j:y * w + j + self.block_w])
+                bufout.append(block_dict.lookup(block))
         return bufout
 
-    def expand_block_keys(self, dict_data):
-        lo = []
-        for idx in range(0, len(dict_data) + 1):
-            for key in list(dict_data.keys()):
-                if dict_data[key] == idx:
-                    vals = key.rsplit('_')
-                    a = int(vals[0])
-                    b = int(vals[1])
-                    c = int(vals[2])
-                    d = int(vals[3])
-                    lo.extend([a, b, c, d])
-        return lo
+    def compress_4x4_dict_array(self, buf, w, h, block_dict):
+        """
+        NumPy version of compress_4x4_dict: finds the unique blocks with a
+        single unique/inverse pass and renumbers them in order of first
+        appearance, so the output matches the pure Python encoder.
+        """
+        stride = self.block_w * self.block_h
+        tiles = numpy.asarray(buf, dtype=numpy.int64).reshape(h // self.block_h, self.block_h,
+                                                              w // self.block_w, self.block_w)
+        blocks = tiles.swapaxes(1, 2).reshape(-1, stride)
+        if len(blocks) == 0:
+            return []
+        bits = int(blocks.max()).bit_length()
+        if blocks.min() >= 0 and bits * stride < 64:
+            # pack each block into a single int64 so unique runs on scalars
+            keys = numpy.zeros(len(blocks), dtype=numpy.int64)
+            for col in range(stride):
+                keys = (keys << bits) | blocks[:, col]
+        else:
+            # compare blocks as opaque byte strings
+            keys = numpy.ascontiguousarray(blocks).view(numpy.dtype((numpy.void, 8 * stride))).reshape(-1)
+        _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        uniq = blocks[first]
+        order = numpy.argsort(first)
+        index = numpy.empty(len(order), dtype=numpy.int64)
+        index[order] = [block_dict.lookup(block) for block in uniq[order].tolist()]
+        return index[inverse.reshape(-1)].tolist()
+
+    def dictionaries(self):
+        """
+        Return the block dictionaries used by the layer mode
+        """
+        if self.mode == 2:
+            return [block_dict for row, data, block_dict in self.compr_blocks[1]]
+        elif self.mode == 4:
+            return [block_dict for data, block_dict in self.rooms_compr_blocks[1]]
+        elif self.mode == 8:
+            return self.rooms_shared_blocks[0]
+        return []
+
+    def tile_mask(self):
+        """
+        Tiles and counts are emitted as unsigned int in mode 1 and as
+        unsigned char in every other mode
+        """
+        return 0xffff if self.mode == 1 else 0xff
+
+    def decode(self):
+        """
+        Decode the encoding selected by the layer mode with the reference
+        decoders, reading the values as wrapped by the emitted C arrays.
+        Segmented modes return the list of decoded segments.
+        """
+        mask = self.tile_mask()
+        if self.mode == 1:
+            return rle_decode([value & mask for value in self.data_rle], 16)
+        elif self.mode == 2:
+            fmt, regions = self.compr_blocks
+            bufout = []
+            for row, data, block_dict in regions:
+                indexes = self.block_indexes(fmt, data)
+                rows = len(indexes) // (self.w // self.block_w) * self.block_h
+                bufout.extend(block_decode([tile & mask for tile in block_dict.expand()],
+                                           indexes, self.w, rows, self.block_w, self.block_h))
+            return bufout
+        elif self.mode == 3:
+            return [rle_decode([value & mask for value in room_data], 8) for room_data in self.data_rooms_rle]
+        elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
+            return [block_decode([tile & mask for tile in room_dict.expand()],
+                                 self.block_indexes(fmt, room_data), self.seg_w, self.seg_h,
+                                 self.block_w, self.block_h)
+                    for room_data, room_dict in rooms]
+        elif self.mode == 5:
+            return [[tile & mask for tile in room] for room in self.data_rooms]
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            return [block_decode([tile & mask for tile in banks[bank].expand()],
+                                 [idx & 0xff for idx in segments[alias][1]], self.seg_w, self.seg_h,
+                                 self.block_w, self.block_h)
+                    for alias, (bank, room_data) in zip(aliases, segments)]
+        elif self.mode == 6:
+            return lz_decode(self.data_lz)
+        elif self.mode == 7:
+            return [lz_decode(room_data) for room_data in self.data_rooms_lz]
+        return [tile & mask for tile in self.data]
+
+    def verify(self):
+        """
+        Check that decoding the layer gives back the original tiles, as far
+        as they fit the width of the emitted arrays
+        """
+        mask = self.tile_mask()
+        if self.mode in (3, 4, 5, 7, 8):
+            return self.decode() == [[tile & mask for tile in room] for room in self.data_rooms]
+        return self.decode() == [tile & mask for tile in self.data]
+
+    def decode_cost(self, model):
+        """
+        Return the estimated T-states needed to decode the whole layer and a
+        screen: for block compression a 32x24 window, for segmented modes the
+        most expensive segment and for RLE and LZ, that cannot be decoded from
+        the middle of a stream, the whole stream.
+        """
+        if self.mode == 1:
+            full = model.rle(self.data_rle)
+            screen = full
+        elif self.mode == 2:
+            fmt, regions = self.compr_blocks
+            full = 0
+            for row, data, block_dict in regions:
+                rows = len(self.block_indexes(fmt, data)) // (self.w // self.block_w) * self.block_h
+                full += model.blocks(self.w, rows, self.block_w, self.block_h) + model.block_indexes(fmt, data)
+            if (self.block_w, self.block_h) == (2, 2) and fmt == BLOCK_INDEX_BYTE:
+                screen = min(full, model.screen_blocks())
+            else:
+                # only 2x2 blocks with byte indexes can be inflated from a window of the map
+                screen = full
+        elif self.mode == 3:
+            costs = [model.rle(room_data) for room_data in self.data_rooms_rle]
+            full = sum(costs)
+            screen = max(costs) if costs else 0
+        elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
+            segment = model.blocks(self.seg_w, self.seg_h, self.block_w, self.block_h)
+            costs = [segment + model.block_indexes(fmt, room_data) for room_data, room_dict in rooms]
+            full = sum(costs)
+            screen = max(costs) if costs else 0
+        elif self.mode == 5:
+            segment = model.raw(self.seg_w * self.seg_h)
+            full = segment * len(self.data_rooms)
+            screen = segment
+        elif self.mode == 8:
+            segment = model.blocks(self.seg_w, self.seg_h, self.block_w, self.block_h)
+            full = segment * len(self.data_rooms)
+            screen = segment
+        elif self.mode == 6:
+            full = model.lz(self.data_lz)
+            screen = full
+        elif self.mode == 7:
+            costs = [model.lz(room_data) for room_data in self.data_rooms_lz]
+            full = sum(costs)
+            screen = max(costs) if costs else 0
+        else:
+            full = model.raw(self.w * self.h)
+            screen = model.raw(min(self.w * self.h, model.SCREEN_W * model.SCREEN_H))
+        return full, screen
+
+    def rle_greedy_sizes(self):
+        """
+        Return the size of the whole map and of all segments encoded with the
+        greedy RLE encoder, to compare with the optimal one
+        """
+        return (len(self.compress_rle_greedy(self.data)),
+                sum(len(self.compress_rle_greedy(room)) for room in self.data_rooms))
+
+    def dump_rle_comparison(self):
+        greedy, greedy_rooms = self.rle_greedy_sizes()
+        optimal = len(self.data_rle)
+        optimal_rooms = sum(len(room_data) for room_data in self.data_rooms_rle)
+        print(("tilelayer [%s] : rle greedy [%d] optimal [%d], segments rle greedy [%d] optimal [%d]" %
+               (self.name, greedy, optimal, greedy_rooms, optimal_rooms)))
 
     def dump(self):
         print(("tilelayer [%s] : uncompressed [%s] rle [%d]" %
@@ -182,39 +1551,109 @@ class TileLayer:
 
     def dump_as_c_header_accessor(self, target_file, basename):
         """
-        Provide accessor for map segments (only makes sense in modes 3 and 4)
+        Provide accessor for map segments (only makes sense in modes 3, 4, 7
+        and 8) and for the regions of block compressed maps with large
+        dictionaries: declare the pointer tables and return the statements
+        filling them, to go in the init_<basename>_tilelayers function shared
+        by all layers
         """
-        if self.mode == 3:
-            print("FATAL: not implemented")
-            exit(1)
+        body = []
+        if self.mode == 2 and self.compr_blocks[0] == BLOCK_INDEX_REGIONS:
+            regions = self.compr_blocks[1]
+            print(("unsigned char *%s_%s_region_dict[%s];" % (basename, self.name, len(regions))), file=target_file)
+            print(("unsigned char *%s_%s_region[%s];" % (basename, self.name, len(regions))), file=target_file)
+            for region_cnt in range(len(regions)):
+                body.append("\t%s_%s_region_dict[%s] = %s_%s_region%s_dict;" % (
+                    basename, self.name, region_cnt, basename, self.name, region_cnt))
+                body.append("\t%s_%s_region[%s] = %s_%s_region%s;" % (
+                    basename, self.name, region_cnt, basename, self.name, region_cnt))
+        elif self.mode == 3:
+            print(("unsigned char *%s_%s_segment_rle[%s];" % (basename, self.name, len(self.data_rooms_rle))),
+                  file=target_file)
+            for room_cnt in range(len(self.data_rooms_rle)):
+                body.append("\t%s_%s_segment_rle[%s] = %s_%s_segment%s_rle;" % (
+                    basename, self.name, room_cnt, basename, self.name, room_cnt))
         elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
             print(
                 ("unsigned char *%s_%s_segment_dict[%s];" % (basename, self.name, len(self.data_rooms_compr_4x4_dict))),
                 file=target_file)
-            print(("unsigned char *%s_%s_segment[%s];" % (basename, self.name, len(self.data_rooms_compr_4x4))),
+            print(("%s *%s_%s_segment[%s];" % (self.block_ctype(fmt), basename, self.name, len(rooms))),
                   file=target_file)
-            print(("void init_%s_tilelayers(void) {" % basename), file=target_file)
-            room_cnt = 0
-            for room_dict in self.data_rooms_compr_4x4_dict:
-                print(("\t%s_%s_segment_dict[%s] = %s_%s_segment%s_dict;" % (
-                basename, self.name, room_cnt, basename, self.name, room_cnt)), file=target_file)
-                room_cnt += 1
-            room_cnt = 0
-            for room_data in self.data_rooms_compr_4x4:
-                print(("\t%s_%s_segment[%s] = %s_%s_segment%s;" % (
-                basename, self.name, room_cnt, basename, self.name, room_cnt)), file=target_file)
-                room_cnt += 1
-            print(("}"), file=target_file)
-        else:
-            pass
-        pass
+            for room_cnt in range(len(self.data_rooms_compr_4x4_dict)):
+                body.append("\t%s_%s_segment_dict[%s] = %s_%s_segment%s_dict;" % (
+                    basename, self.name, room_cnt, basename, self.name, room_cnt))
+            for room_cnt in range(len(self.data_rooms_compr_4x4)):
+                body.append("\t%s_%s_segment[%s] = %s_%s_segment%s;" % (
+                    basename, self.name, room_cnt, basename, self.name, room_cnt))
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            print(("unsigned char *%s_%s_segment_dict[%s];" % (basename, self.name, len(segments))), file=target_file)
+            print(("unsigned char *%s_%s_segment[%s];" % (basename, self.name, len(segments))), file=target_file)
+            for room_cnt, (bank, room_data) in enumerate(segments):
+                body.append("\t%s_%s_segment_dict[%s] = %s_%s_bank%s_dict;" % (
+                    basename, self.name, room_cnt, basename, self.name, bank))
+            for room_cnt, alias in enumerate(aliases):
+                body.append("\t%s_%s_segment[%s] = %s_%s_segment%s;" % (
+                    basename, self.name, room_cnt, basename, self.name, alias))
+        elif self.mode == 7:
+            print(("unsigned char *%s_%s_segment_lz[%s];" % (basename, self.name, len(self.data_rooms_lz))),
+                  file=target_file)
+            for room_cnt in range(len(self.data_rooms_lz)):
+                body.append("\t%s_%s_segment_lz[%s] = %s_%s_segment%s_lz;" % (
+                    basename, self.name, room_cnt, basename, self.name, room_cnt))
+        return body
+
+    def dump_mode(self, file, basename):
+        print(("/* tile layer %s: %s%s */" % (self.name, MODE_NAMES[self.mode],
+                                             ' segmented' if self.segment else '')), file=file)
+        for reason in self.mode_reasons:
+            print(("/*   auto %s */" % reason), file=file)
+        print(("#define %s_%s_MODE %s" % (basename.upper(), self.name.upper(), self.mode)), file=file)
+        for kind, (tiles, offsets) in self.scroll_strips.items():
+            print(("/* %s strips: %s unique of %s */" % (kind, len(tiles) // (self.h if kind == 'column' else self.w),
+                                                      len(offsets))), file=file)
+            print(("#define %s_%s_SCROLL_%sS" % (basename.upper(), self.name.upper(), kind.upper())), file=file)
+        if self.tiles:
+            used, segments = self.tile_usage
+            print(("/* tiles: %s used%s */" % (len(used), ', up to %s per segment' % max(map(len, segments))
+                                               if segments else '')), file=file)
+            print(("#define %s_%s_TILES %s" % (basename.upper(), self.name.upper(), len(used))), file=file)
+        if self.patterns is not None:
+            print(("#define %s_%s_PATTERNS %s" % (basename.upper(), self.name.upper(), len(self.patterns))),
+                  file=file)
+        if self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            print(("/* shared dictionary: %s blocks in %s banks, %s unique segments of %s */" % (
+                sum(len(bank_dict) for bank_dict in banks), len(banks), len(set(aliases)), len(aliases))), file=file)
+            print(("#define %s_%s_BLOCK_W %s" % (basename.upper(), self.name.upper(), self.block_w)), file=file)
+            print(("#define %s_%s_BLOCK_H %s" % (basename.upper(), self.name.upper(), self.block_h)), file=file)
+        if self.mode in (2, 4):
+            fmt = self.compr_blocks[0] if self.mode == 2 else self.rooms_compr_blocks[0]
+            print(("#define %s_%s_BLOCK_W %s" % (basename.upper(), self.name.upper(), self.block_w)), file=file)
+            print(("#define %s_%s_BLOCK_H %s" % (basename.upper(), self.name.upper(), self.block_h)), file=file)
+            if fmt != BLOCK_INDEX_BYTE:
+                print(("/* block indexes: %s */" % BLOCK_INDEX_NAMES[fmt]), file=file)
+                print(("#define %s_%s_BLOCK_INDEX %s" % (basename.upper(), self.name.upper(), fmt)), file=file)
 
     def dump_as_c_header_no_data(self, file, basename):
         print(("extern const unsigned char %s_%s_w;" % (basename, self.name)), file=file)
         print(("extern const unsigned char %s_%s_h;" % (basename, self.name)), file=file)
+        for kind in self.scroll_strips:
+            print(("extern const unsigned char %s_%s_%ss[];" % (basename, self.name, kind)), file=file)
+            print(("extern const unsigned int %s_%s_%s_offset[];" % (basename, self.name, kind)), file=file)
+        for symbol, ctype, values in self.tile_usage_tables(basename):
+            print(("extern const %s %s[];" % (ctype, symbol)), file=file)
         if self.mode == 1:
             # RLE
             print(("extern const unsigned int %s_rle[];" % self.name), file=file)
+        elif self.mode == 2 and self.compr_blocks[0] == BLOCK_INDEX_REGIONS:
+            print(("extern const unsigned char %s_%s_regions;" % (basename, self.name)), file=file)
+            for region_cnt in range(len(self.compr_blocks[1])):
+                print(("extern const unsigned char %s_%s_region%s_dict[];" % (basename, self.name, region_cnt)),
+                      file=file)
+                print(("extern const unsigned char %s_%s_region%s[];" % (basename, self.name, region_cnt)),
+                      file=file)
         elif self.mode == 2:
             # 4x4 Blocks
             print(("extern const unsigned int %s_cmpr_size;" % (self.name)), file=file)
@@ -223,7 +1662,8 @@ class TileLayer:
         elif self.mode == 3:
             room_cnt = 0
             for room_data in self.data_rooms_rle:
-                print(("extern const unsigned int segment%s_%s_rle[];" % (room_cnt, self.name)), file=file)
+                print(("extern const unsigned char %s_%s_segment%s_rle[];" % (basename, self.name, room_cnt)),
+                      file=file)
                 room_cnt += 1
         elif self.mode == 4:
             room_cnt = 0
@@ -232,9 +1672,32 @@ class TileLayer:
                       file=file)
                 room_cnt += 1
             room_cnt = 0
+            fmt, rooms = self.rooms_compr_blocks
             for room_data in self.data_rooms_compr_4x4:
-                print(("extern const unsigned char %s_%s_segment%s[];" % (basename, self.name, room_cnt)), file=file)
+                print(("extern const %s %s_%s_segment%s[];" % (self.block_ctype(fmt), basename, self.name, room_cnt)),
+                      file=file)
                 room_cnt += 1
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            for bank in range(len(banks)):
+                print(("extern const unsigned char %s_%s_bank%s_dict[];" % (basename, self.name, bank)), file=file)
+            for room_cnt, alias in enumerate(aliases):
+                if alias == room_cnt:
+                    print(("extern const unsigned char %s_%s_segment%s[];" % (basename, self.name, room_cnt)),
+                          file=file)
+                else:
+                    # identical segments are emitted once
+                    print(("#define %s_%s_segment%s %s_%s_segment%s" % (
+                        basename, self.name, room_cnt, basename, self.name, alias)), file=file)
+                    print(("#define %s_%s_segment%s_size %s_%s_segment%s_size" % (
+                        basename, self.name, room_cnt, basename, self.name, alias)), file=file)
+        elif self.mode == 6:
+            print(("extern const unsigned int %s_%s_lz_size;" % (basename, self.name)), file=file)
+            print(("extern const unsigned char %s_%s_lz[];" % (basename, self.name)), file=file)
+        elif self.mode == 7:
+            for room_cnt, room_data in enumerate(self.data_rooms_lz):
+                print(("extern const unsigned char %s_%s_segment%s_lz[];" % (basename, self.name, room_cnt)),
+                      file=file)
         else:
             print(("extern const unsigned char %s_%s[];" % (basename, self.name)), file=file)
 
@@ -243,9 +1706,13 @@ class TileLayer:
             mode indicates compression:
             0 : uncompressed
             1 : rle
-            2 : 4x4 block compression
+            2 : block compression, 2x2 blocks unless set by rl_block
             3 : split in rooms and compressed rle
-            4 : split in rooms and compress using 4x4 blocks
+            4 : split in rooms and compress using blocks
+            5 : split in rooms, uncompressed
+            6 : lz
+            7 : split in rooms and compressed lz
+            8 : split in rooms and compress using blocks from a shared dictionary
         """
         total_size = 0
         print(("const unsigned char %s_%s_w = %s;" % (basename, self.name, self.w)), file=file)
@@ -255,24 +1722,38 @@ class TileLayer:
             print(("const unsigned int %s_%s_rle_size = %s;" % (basename, self.name, len(self.data_rle))), file=file)
             print(("const unsigned int %s_%s_rle[] = {" % (basename, self.name)), file=file)
             total_size += len(self.data_rle)
-            for tile in self.data_rle:
-                print(("%s," % tile), end=' ', file=file)
+            file.write(c_values(self.data_rle))
             print("0 };", file=file)
+        elif self.mode == 2 and self.compr_blocks[0] == BLOCK_INDEX_REGIONS:
+            # Blocks, in bands of rows with their own dictionary
+            regions = self.compr_blocks[1]
+            print(("const unsigned char %s_%s_regions = %s;" % (basename, self.name, len(regions))), file=file)
+            for region_cnt, (row, region_data, region_dict) in enumerate(regions):
+                name = '%s_%s_region%s' % (basename, self.name, region_cnt)
+                print(("const unsigned int %s_row = %s;" % (name, row)), file=file)
+                print(("const unsigned int %s_size = %s;" % (name, len(region_data))), file=file)
+                print(("const unsigned char %s_dict[] = {" % name), end=' ', file=file)
+                dict_data = region_dict.expand()
+                total_size += len(dict_data)
+                file.write(c_values(dict_data))
+                print("0 };", file=file)
+                print(("const unsigned char %s[] = {" % name), end=' ', file=file)
+                total_size += len(region_data)
+                file.write(c_values(region_data))
+                print("0 };", file=file)
         elif self.mode == 2:
             # 4x4 Blocks
-            if len(self.data_compr_4x4_dict) > 256:
-                print("FATAL: block compression dictionary too big")
-                exit(1)
-            print(("const unsigned int %s_%s_size = %s;" % (basename, self.name, len(self.data_compr_4x4))), file=file)
+            fmt, regions = self.compr_blocks
+            row, data, block_dict = regions[0]
+            print(("const unsigned int %s_%s_size = %s;" % (basename, self.name, len(data))), file=file)
             print(("const unsigned char %s_%s_dict[] = {" % (basename, self.name)), end=' ', file=file)
-            total_size += len(self.expand_block_keys(self.data_compr_4x4_dict))
-            for tile in self.expand_block_keys(self.data_compr_4x4_dict):
-                print(("%s," % tile), end=' ', file=file)
+            dict_data = block_dict.expand()
+            total_size += len(dict_data)
+            file.write(c_values(dict_data))
             print("0 };", file=file)
-            print(("const unsigned char %s_%s[] = {" % (basename, self.name)), end=' ', file=file)
-            total_size += len(self.data_compr_4x4) * 2
-            for tile in self.data_compr_4x4:
-                print(("%s," % tile), end=' ', file=file)
+            print(("const %s %s_%s[] = {" % (self.block_ctype(fmt), basename, self.name)), end=' ', file=file)
+            total_size += len(data) * 2
+            file.write(c_values(data))
             print("0 };", file=file)
         elif self.mode == 3:
             room_cnt = 0
@@ -281,39 +1762,286 @@ class TileLayer:
                     basename, self.name, room_cnt, len(room_data))), file=file)
                 print(("const unsigned char %s_%s_segment%s_rle[] = {" % (basename, self.name, room_cnt)), file=file)
                 total_size += len(room_data)
-                for tile in room_data:
-                    print(("%s," % tile), end=' ', file=file)
+                file.write(c_values(room_data))
                 print("0 };", file=file)
                 room_cnt += 1
         elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
+            sizes_ctype = size_ctype(len(room_data) for room_data, room_dict in rooms)
             room_cnt = 0
-            for room_dict in self.data_rooms_compr_4x4_dict:
+            for room_data, room_dict in rooms:
                 print(("const unsigned char %s_%s_segment%s_dict[] = {" % (basename, self.name, room_cnt)), end=' ',
                       file=file)
-                total_size += len(self.expand_block_keys(room_dict))
-                for tile in self.expand_block_keys(room_dict):
-                    print(("%s," % tile), end=' ', file=file)
+                dict_data = room_dict.expand()
+                total_size += len(dict_data)
+                file.write(c_values(dict_data))
                 print("0 };", file=file)
                 room_cnt += 1
             room_cnt = 0
-            for room_data in self.data_rooms_compr_4x4:
-                print(("const unsigned char %s_%s_segment%s_size = %s;" % (
-                    basename, self.name, room_cnt, len(room_data))), file=file)
+            for room_data, room_dict in rooms:
+                print(("const %s %s_%s_segment%s_size = %s;" % (
+                    sizes_ctype, basename, self.name, room_cnt, len(room_data))), file=file)
+                print(("const %s %s_%s_segment%s[] = {" % (self.block_ctype(fmt), basename, self.name, room_cnt)),
+                      end=' ', file=file)
+                total_size += len(room_data)
+                file.write(c_values(room_data))
+                print("0 };", file=file)
+                room_cnt += 1
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            for bank, bank_dict in enumerate(banks):
+                print(("const unsigned char %s_%s_bank%s_dict[] = {" % (basename, self.name, bank)), end=' ',
+                      file=file)
+                dict_data = bank_dict.expand()
+                total_size += len(dict_data)
+                file.write(c_values(dict_data))
+                print("0 };", file=file)
+            sizes_ctype = size_ctype(len(room_data) for bank, room_data in segments)
+            for room_cnt, (bank, room_data) in enumerate(segments):
+                if aliases[room_cnt] != room_cnt:
+                    continue
+                print(("const %s %s_%s_segment%s_size = %s;" % (
+                    sizes_ctype, basename, self.name, room_cnt, len(room_data))), file=file)
                 print(("const unsigned char %s_%s_segment%s[] = {" % (basename, self.name, room_cnt)), end=' ',
                       file=file)
                 total_size += len(room_data)
-                for tile in room_data:
-                    print(("%s," % tile), end=' ', file=file)
+                file.write(c_values(room_data))
+                print("0 };", file=file)
+        elif self.mode == 6:
+            print(("const unsigned int %s_%s_lz_size = %s;" % (basename, self.name, len(self.data_lz))), file=file)
+            print(("const unsigned char %s_%s_lz[] = {" % (basename, self.name)), file=file)
+            total_size += len(self.data_lz)
+            file.write(c_values(self.data_lz))
+            print("0 };", file=file)
+        elif self.mode == 7:
+            for room_cnt, room_data in enumerate(self.data_rooms_lz):
+                print(("const unsigned int %s_%s_segment%s_lz_size = %s;" % (
+                    basename, self.name, room_cnt, len(room_data))), file=file)
+                print(("const unsigned char %s_%s_segment%s_lz[] = {" % (basename, self.name, room_cnt)), file=file)
+                total_size += len(room_data)
+                file.write(c_values(room_data))
                 print("0 };", file=file)
-                room_cnt += 1
         else:
             # uncompressed output (should not be allowed?)
             print(("const unsigned char %s_%s[] = {" % (basename, self.name)), file=file)
             total_size += len(self.data)
-            for tile in self.data:
-                val = (tile % 256)
-                print(("%s," % val), end=' ', file=file)
+            file.write(c_values([tile % 256 for tile in self.data]))
             print("0 };", file=file)
+        total_size += self.dump_scroll_strips(file, basename)
+        total_size += self.dump_tile_usage(file, basename)
+        print(("// TOTAL_SIZE %s" % total_size), file=file)
+        return total_size
+
+    def encoding_stats(self):
+        """
+        Return the bytes of every segment and the size of every block
+        dictionary of the selected encoding, segments aliasing another one
+        take no bytes
+        """
+        segments = []
+        dictionaries = []
+        if self.mode == 2:
+            dictionaries = [block_dict for row, data, block_dict in self.compr_blocks[1]]
+        elif self.mode == 3:
+            segments = [len(room_data) for room_data in self.data_rooms_rle]
+        elif self.mode == 4:
+            rooms = self.rooms_compr_blocks[1]
+            segments = [len(room_data) for room_data, room_dict in rooms]
+            dictionaries = [room_dict for room_data, room_dict in rooms]
+        elif self.mode == 5:
+            segments = [len(room) for room in self.data_rooms]
+        elif self.mode == 7:
+            segments = [len(room_data) for room_data in self.data_rooms_lz]
+        elif self.mode == 8:
+            banks, rooms, aliases = self.rooms_shared_blocks
+            segments = [len(room_data) if aliases[room_cnt] == room_cnt else 0
+                        for room_cnt, (bank, room_data) in enumerate(rooms)]
+            dictionaries = banks
+        return {'mode': MODE_NAMES.get(self.mode, 'raw'), 'segments': segments,
+                'dictionaries': [{'blocks': len(block_dict), 'bytes': len(block_dict.expand())}
+                                 for block_dict in dictionaries]}
+
+    def binary_payloads(self, basename):
+        """
+        Return the (symbol, type, data) payloads of the layer for binary output,
+        packed the way the equivalent C arrays are typed, terminator included.
+        """
+        name = '%s_%s' % (basename, self.name)
+        payloads = []
+        if self.mode == 1:
+            payloads.append((name + '_rle', 'unsigned int', pack_words(self.data_rle + [0])))
+        elif self.mode == 2 and self.compr_blocks[0] == BLOCK_INDEX_REGIONS:
+            for region_cnt, (row, region_data, region_dict) in enumerate(self.compr_blocks[1]):
+                payloads.append(('%s_region%s_dict' % (name, region_cnt), 'unsigned char',
+                                 pack_bytes(region_dict.expand() + [0])))
+                payloads.append(('%s_region%s' % (name, region_cnt), 'unsigned char', pack_bytes(region_data + [0])))
+        elif self.mode == 2:
+            fmt, regions = self.compr_blocks
+            row, data, block_dict = regions[0]
+            pack = pack_words if fmt == BLOCK_INDEX_WIDE else pack_bytes
+            payloads.append((name + '_dict', 'unsigned char', pack_bytes(block_dict.expand() + [0])))
+            payloads.append((name, self.block_ctype(fmt), pack(data + [0])))
+        elif self.mode == 3:
+            for room_cnt, room_data in enumerate(self.data_rooms_rle):
+                payloads.append(('%s_segment%s_rle' % (name, room_cnt), 'unsigned char', pack_bytes(room_data + [0])))
+        elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
+            pack = pack_words if fmt == BLOCK_INDEX_WIDE else pack_bytes
+            for room_cnt, (room_data, room_dict) in enumerate(rooms):
+                payloads.append(('%s_segment%s_dict' % (name, room_cnt), 'unsigned char',
+                                 pack_bytes(room_dict.expand() + [0])))
+            for room_cnt, (room_data, room_dict) in enumerate(rooms):
+                payloads.append(('%s_segment%s' % (name, room_cnt), self.block_ctype(fmt), pack(room_data + [0])))
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            for bank, bank_dict in enumerate(banks):
+                payloads.append(('%s_bank%s_dict' % (name, bank), 'unsigned char', pack_bytes(bank_dict.expand() + [0])))
+            for room_cnt, (bank, room_data) in enumerate(segments):
+                if aliases[room_cnt] == room_cnt:
+                    payloads.append(('%s_segment%s' % (name, room_cnt), 'unsigned char', pack_bytes(room_data + [0])))
+        elif self.mode == 6:
+            payloads.append((name + '_lz', 'unsigned char', pack_bytes(self.data_lz + [0])))
+        elif self.mode == 7:
+            for room_cnt, room_data in enumerate(self.data_rooms_lz):
+                payloads.append(('%s_segment%s_lz' % (name, room_cnt), 'unsigned char', pack_bytes(room_data + [0])))
+        else:
+            payloads.append((name, 'unsigned char', pack_bytes(list(self.data) + [0])))
+        return payloads
+
+    def dump_as_binary(self, file, basename):
+        """ Dump tile layer as a C header with sizes and extern declarations,
+            the data itself goes to the returned (symbol, type, data) payloads,
+            each to be written as a raw binary blob.
+
+            Blobs are linked with the bundled xxd -i, which defines them as
+            const char <blob>_bin[], so each array is declared exactly so and
+            aliased to a pointer of its type under the name used by the C
+            header output.
+        """
+        print(("const unsigned char %s_%s_w = %s;" % (basename, self.name, self.w)), file=file)
+        print(("const unsigned char %s_%s_h = %s;" % (basename, self.name, self.h)), file=file)
+        if self.mode == 1:
+            print(("const unsigned int %s_%s_rle_size = %s;" % (basename, self.name, len(self.data_rle))), file=file)
+        elif self.mode == 2 and self.compr_blocks[0] == BLOCK_INDEX_REGIONS:
+            regions = self.compr_blocks[1]
+            print(("const unsigned char %s_%s_regions = %s;" % (basename, self.name, len(regions))), file=file)
+            for region_cnt, (row, region_data, region_dict) in enumerate(regions):
+                print(("const unsigned int %s_%s_region%s_row = %s;" % (basename, self.name, region_cnt, row)),
+                      file=file)
+                print(("const unsigned int %s_%s_region%s_size = %s;" % (
+                    basename, self.name, region_cnt, len(region_data))), file=file)
+        elif self.mode == 2:
+            print(("const unsigned int %s_%s_size = %s;" % (basename, self.name, len(self.compr_blocks[1][0][1]))),
+                  file=file)
+        elif self.mode == 3:
+            for room_cnt, room_data in enumerate(self.data_rooms_rle):
+                print(("const unsigned char %s_%s_segment%s_rle_size = %s;" % (
+                    basename, self.name, room_cnt, len(room_data))), file=file)
+        elif self.mode == 4:
+            fmt, rooms = self.rooms_compr_blocks
+            sizes_ctype = size_ctype(len(room_data) for room_data, room_dict in rooms)
+            for room_cnt, (room_data, room_dict) in enumerate(rooms):
+                print(("const %s %s_%s_segment%s_size = %s;" % (
+                    sizes_ctype, basename, self.name, room_cnt, len(room_data))), file=file)
+        elif self.mode == 8:
+            banks, segments, aliases = self.rooms_shared_blocks
+            sizes_ctype = size_ctype(len(room_data) for bank, room_data in segments)
+            for room_cnt, (bank, room_data) in enumerate(segments):
+                if aliases[room_cnt] == room_cnt:
+                    print(("const %s %s_%s_segment%s_size = %s;" % (
+                        sizes_ctype, basename, self.name, room_cnt, len(room_data))), file=file)
+        elif self.mode == 6:
+            print(("const unsigned int %s_%s_lz_size = %s;" % (basename, self.name, len(self.data_lz))), file=file)
+        elif self.mode == 7:
+            for room_cnt, room_data in enumerate(self.data_rooms_lz):
+                print(("const unsigned int %s_%s_segment%s_lz_size = %s;" % (
+                    basename, self.name, room_cnt, len(room_data))), file=file)
+        payloads = (self.binary_payloads(basename) + self.scroll_payloads(basename) +
+                    self.tile_usage_payloads(basename))
+        total_size = 0
+        for symbol, ctype, data in payloads:
+            print(("extern const char %s_bin[];" % symbol), file=file)
+            print(("#define %s ((const %s *)%s_bin)" % (symbol, ctype, symbol)), file=file)
+            total_size += len(data)
+        print(("// TOTAL_SIZE %s" % total_size), file=file)
+        return total_size, payloads
+
+
+class CollisionLayer:
+    """
+    Collision map derived from a tile layer, with the collision class of each
+    tile packed in 1 bit if the layer is only solid or empty, 2 otherwise.
+    Every segment is stored on its own, with a row offset table shared by all
+    of them, so a tile is looked up with a shift and a mask.
+    """
+
+    def __init__(self, name, w, h, data, classes, seg_w, seg_h):
+        self.name = name
+        self.w = w
+        self.h = h
+        self.seg_w = seg_w
+        self.seg_h = seg_h
+        if classes:
+            self.tiles = [classes.get(tile & 0x1fffffff, 0) for tile in data]
+        else:
+            # a layer drawn only for collisions, any tile is solid
+            self.tiles = [1 if tile else 0 for tile in data]
+        self.bits = 1 if max(self.tiles, default=0) <= 1 else 2
+        self.stride = (seg_w * self.bits + 7) // 8
+
+    @cached_property
+    def segments(self):
+        """
+        Packed bitmap of every segment, in the order of the tile layer segments
+        """
+        per_byte = 8 // self.bits
+        segments = []
+        for by in range(self.h // self.seg_h):
+            for bx in range(self.w // self.seg_w):
+                packed = []
+                for y in range(by * self.seg_h, (by + 1) * self.seg_h):
+                    row = bytearray(self.stride)
+                    offset = y * self.w + bx * self.seg_w
+                    for x, tile in enumerate(self.tiles[offset:offset + self.seg_w]):
+                        row[x // per_byte] |= tile << (x % per_byte * self.bits)
+                    packed.extend(row)
+                segments.append(packed)
+        return segments
+
+    @property
+    def rows(self):
+        return [y * self.stride for y in range(self.seg_h)]
+
+    def dump_as_c_header_no_data(self, file, basename):
+        name = '%s_%s_collision' % (basename, self.name)
+        print(("extern const unsigned int %s_row[];" % name), file=file)
+        for segment_cnt in range(len(self.segments)):
+            print(("extern const unsigned char %s%s[];" % (name, segment_cnt)), file=file)
+        print(("#define %s_BITS %s" % (name.upper(), self.bits)), file=file)
+        print(("#define %s_STRIDE %s" % (name.upper(), self.stride)), file=file)
+        print(("#define %s_SEGMENTS %s" % (name.upper(), len(self.segments))), file=file)
+
+    def dump_as_c_header_accessor(self, target_file, basename):
+        name = '%s_%s' % (basename, self.name)
+        print(("unsigned char *%s_segment_collision[%s];" % (name, len(self.segments))), file=target_file)
+        print(("void init_%s_collision(void) {" % name), file=target_file)
+        for segment_cnt in range(len(self.segments)):
+            print(("\t%s_segment_collision[%s] = %s_collision%s;" % (name, segment_cnt, name, segment_cnt)),
+                  file=target_file)
+        print(("}"), file=target_file)
+
+    def dump_as_c_header(self, file, basename):
+        name = '%s_%s_collision' % (basename, self.name)
+        total_size = 0
+        print(("const unsigned int %s_row[] = {" % name), end=' ', file=file)
+        total_size += len(self.rows) * 2
+        file.write(c_values(self.rows))
+        print("};", file=file)
+        for segment_cnt, packed in enumerate(self.segments):
+            print(("const unsigned char %s%s[] = {" % (name, segment_cnt)), end=' ', file=file)
+            total_size += len(packed)
+            file.write(c_values(packed))
+            print("};", file=file)
         print(("// TOTAL_SIZE %s" % total_size), file=file)
         return total_size
 
@@ -322,7 +2050,7 @@ class ObjectGroupLayer:
     """ Contains an object group layer
     """
 
-    def __init__(self, raw):
+    def __init__(self, raw, grid=None, schema=None):
         # self.w = raw['width']
         # self.h = raw['height']
         self.x = raw['x']
@@ -332,44 +2060,14 @@ class ObjectGroupLayer:
         self.visible = raw['visible']
         # self.draworder = raw['draworder']
         self.raw_objects = raw['objects']
+        # the schema is shared by all the object layers of the map
+        self.schema = schema if schema is not None else ObjectSchema()
         self.objects = []
         for obj in self.raw_objects:
             self.objects.append(MapObject(obj))
-        self.extract_properties()  # we run this globa
-
-    def extract_properties(self):
-        """
-        Extract properties just for this Object Layer
-        """
-        self.object_properties = {}
-        self.enum_properties = {}
-        self.max_num_properties = {}
-        for item in self.raw_objects:
-            # find all types or names
-            _type = item['type']
-            if _type == '':
-                _type = item['name']
-            if 'properties' in item:
-                # Add properties to dict avoiding repetitions.
-                if _type in self.object_properties:
-                    already_added = set(self.object_properties[_type])
-                    new_items = set(item['properties'].keys())
-                    to_be_added = new_items - already_added
-                    self.object_properties[_type] = self.object_properties[_type] + list(to_be_added)
-                else:
-                    self.object_properties[_type] = list(item['properties'].keys())
-                length = len(list(item['properties'].keys()))
-                ## this works for a single layer not the whole thing.
-                ## maybe replace padding with a special scan?
-                # if length > self.max_num_properties[_type]:
-                #    self.max_num_properties[_type] = length
-                ## Find Properties that require enums
-                for _property in list(item['properties'].keys()):
-                    value = item['properties'][_property]
-                    if (not value.isdigit() and not value.replace('.', '').isdigit()):
-                        if not _property in self.enum_properties:
-                            self.enum_properties[_property] = {}
-                        self.enum_properties[_property][value.encode('ascii', 'ignore')] = '1'
+            self.schema.add(obj)
+        # grid is (columns, rows, cell width, cell height), cells in pixels
+        self.grid = grid
 
     def dump(self):
         print(("object group : [%s] (%s, %s)" % (self.name, self.x, self.y)))
@@ -382,50 +2080,100 @@ class ObjectGroupLayer:
         for item in self.raw_objects:
             print(("extern const unsigned char %s_%s_objs[];\n" % (basename, self.name)), end='', file=file)
             # count = count + 1
+        if self.grid is not None:
+            name = '%s_%s' % (basename, self.name)
+            print(("extern const unsigned int %s_objs_offset[];" % name), file=file)
+            print(("extern const unsigned char %s_objs_count[];" % name), file=file)
+            print(("#define %s_OBJS_CELLS %s" % (name.upper(), self.grid[0] * self.grid[1])), file=file)
+            print(("#define %s_OBJS_COLUMNS %s" % (name.upper(), self.grid[0])), file=file)
+            print(("#define %s_cell_objs(cell) (%s_objs + %s_objs_offset[cell])" % (name, name, name)), file=file)
+
+    def object_cell(self, item):
+        """
+        Return the grid cell holding the top left corner of an object,
+        objects outside of the map go to the nearest cell
+        """
+        columns, rows, cell_w, cell_h = self.grid
+        column = min(max(int(item['x'] // cell_w), 0), columns - 1)
+        row = min(max(int(item['y'] // cell_h), 0), rows - 1)
+        return row * columns + column
+
+    def dump_object(self, file, item, packing=None):
+        """
+        Dump the fields of a single object, returns its size in bytes
+        """
+        if packing is not None:
+            record = packing.pack(item)
+            print(("%s," % ', '.join(str(value) for value in record)), end=' ', file=file)
+            return len(record)
+        _type = self.schema.object_type(item)
+        # type is like MOVABLE, coordinates should be able to be negative up to -32
+        print(("%s, %s, %s, %s, %s, %s," % (_type.upper(),
+                                            round(item['x'] % 256, 10), round(item['y'] % 176, 10), item['width'],
+                                            item['height'], 1 if item['visible'] else 0)), end=' ', file=file)
+        properties = self.schema.properties(item)
+        for _property in self.schema.types[_type]:
+            value = properties.get(_property, "0")
+            if self.schema.is_enum(_property, value):
+                ## this is like TYPE_TEMPLAR
+                print(("%s_%s," % (_property.upper(), value.upper())), end=' ', file=file)
+            elif value.isdigit():
+                wrap = int(value) % 256
+                ## regular numeric value, wrapped to byte
+                print(("%s," % wrap), end=' ', file=file)
+            else:
+                print(("%s," % (value.replace('.', ''))), end=' ', file=file)
+        return 6 + len(self.schema.types[_type])
 
-    def dump_as_c_header(self, file, basename, global_properties):
+    def dump_as_c_header_indexed(self, file, basename, packing=None):
+        """
+        Dump the objects grouped by grid cell, each cell terminated by 255 so
+        the objects of a room are scanned as a whole layer used to be, with
+        tables of the offset and number of objects of every cell.
+        """
+        columns, rows, cell_w, cell_h = self.grid
+        cells = [[] for cell in range(columns * rows)]
+        for item in self.raw_objects:
+            cells[self.object_cell(item)].append(item)
+        offsets = []
+        offset = 0
+        print(("const unsigned char %s_%s_objs[] = {" % (basename, self.name)), end=' ', file=file)
+        for items in cells:
+            offsets.append(offset)
+            for item in items:
+                offset += self.dump_object(file, item, packing)
+            print("255,", end=' ', file=file)
+            offset += 1
+        print(("255};"), file=file)
+        print(("const unsigned int %s_%s_objs_offset[] = {" % (basename, self.name)), end=' ', file=file)
+        file.write(c_values(offsets))
+        print("};", file=file)
+        print(("const unsigned char %s_%s_objs_count[] = {" % (basename, self.name)), end=' ', file=file)
+        file.write(c_values([len(items) for items in cells]))
+        print("};", file=file)
+        return offset + 1 + len(cells) * 3
+
+    def dump_as_c_header(self, file, basename, packing=None):
         # Need to dump all the objects in a room in a sequence --
         # map_room00_objs[] = {<OBJ1>, <OBJ2>, ... <TERMINATION>}
         # map_room01_objs[] = ...
 
         # in init just asign each room to a an array item.
 
+        if self.grid is not None:
+            return self.dump_as_c_header_indexed(file, basename, packing)
         count = 0
         total_size = 0
         # print >>file,("const unsigned char %s_%s_size = %s;\n" % (basename, self.name, len(self.raw_objects)))
         print(("const unsigned char %s_%s_objs[] = {" % (basename, self.name)), end=' ', file=file)
         for item in self.raw_objects:
             # print >>file,("const unsigned char %s_%s_obj%s[] = {" % (basename, self.name, count)),
-            _type = item['type']
-            if _type == '':
-                _type = item['name']
-            # type is like MOVABLE, coordinates should be able to be negative up to -32
-            print(("%s, %s, %s, %s, %s, %s," % (_type.upper(),
-                                                round(item['x'] % 256, 10), round(item['y'] % 176, 10), item['width'],
-                                                item['height'], 1 if item['visible'] else 0)), end=' ', file=file)
-            total_size += 6
-            for _property in global_properties[_type]:
-                if 'properties' in item and _property in item['properties']:
-                    value = item['properties'][_property]
-                else:
-                    value = "0"
-                if _property in self.enum_properties and not value.isdigit():
-                    ## this is like TYPE_TEMPLAR
-                    print(("%s_%s," % (_property.upper(), value.upper())), end=' ', file=file)
-                elif not value.isdigit() and value.replace('.', '').isdigit:
-                    print(("%s," % (value.replace('.', ''))), end=' ', file=file)
-                elif value.isdigit():
-                    wrap = int(value) % 256
-                    ## regular numeric value, wrapped to byte
-                    print(("%s," % wrap), end=' ', file=file)
-                else:
-                    print(("%s," % value), end=' ', file=file)
-            total_size += len(self.object_properties[_type])
+            total_size += self.dump_object(file, item, packing)
             ## add padding if needed (should never be neeeded anymore)
             ## something else is still wrong over here...
             ## problem is that we need to add padding for each type - to ensure consistency -
 
-            # padding = self.max_num_properties - len(self.object_properties[_type]) + 2
+            # padding = self.max_num_properties - len(self.schema.types[_type]) + 2
             # print padding
             # for i in xrange(padding):
             #     print >>file,("0,"),
@@ -437,17 +2185,17 @@ class ObjectGroupLayer:
         """ Dump data structures and definitions
             to interpret the data from C code.
         """
-        if len(list(self.object_properties.keys())) > 0:
+        if len(self.schema.types) > 0:
             print("\nenum object_type {")
-            for key in list(self.object_properties.keys()):
+            for key in self.schema.types:
                 print(("    %s, " % key.upper()))
             print("};\n")
 
             ## enum_properties
-            for key in self.enum_properties:
-                print(("\nenum object_property_%s {" % key.encode('ascii', 'ignore')))
-                for _property in self.enum_properties[key]:
-                    print(("    %s_%s, " % (key.encode('ascii', 'ignore').upper(), _property.upper())))
+            for key in self.schema.enums:
+                print(("\nenum object_property_%s {" % key))
+                for _property in self.schema.enums[key]:
+                    print(("    %s_%s, " % (key.upper(), _property.upper())))
                 print("};\n")
 
     def dump_initializer(self):
@@ -459,7 +2207,7 @@ class ObjectGroupLayer:
 class TiledMap:
     """ Contains Tiled Map Data """
 
-    def __init__(self, raw_map):
+    def __init__(self, raw_map, previous=None):
         self.map_version = raw_map['version']
         self.map_orientation = raw_map['orientation']
         self.tile_w = raw_map['tilewidth']
@@ -471,25 +2219,59 @@ class TiledMap:
         self.segment_h = self.map_h
         self.compr = None
         self.segment = False
+        self.decode_budget = None
+        self.block_size = (2, 2)
+        self.dict_cap = 256
+        self.scroll = None
+        self.object_grid = None
+        self.object_pack = False
+        self.collision = None
+        self.tiles = None
         #
         # Read custom properties from the map
         #
-        if 'properties' in raw_map:
-            if 'rl_compr' in raw_map['properties']:
-                self.compr = raw_map['properties']['rl_compr'].lower()
-            if 'rl_segment' in raw_map['properties']:
-                self.segment = raw_map['properties']['rl_segment'].lower()
-            if 'rl_seg_w' in raw_map['properties']:
-                self.segment_w = int(raw_map['properties']['rl_seg_w'])
-            if 'rl_seg_h' in raw_map['properties']:
-                self.segment_h = int(raw_map['properties']['rl_seg_h'])
-        if self.compr != 'rle' and self.compr != 'block':
+        properties = get_properties(raw_map)
+        if 'rl_compr' in properties:
+            self.compr = str(properties['rl_compr']).lower()
+        if 'rl_segment' in properties:
+            self.segment = str(properties['rl_segment']).lower()
+        if 'rl_seg_w' in properties:
+            self.segment_w = int(properties['rl_seg_w'])
+        if 'rl_seg_h' in properties:
+            self.segment_h = int(properties['rl_seg_h'])
+        if 'rl_decode_budget' in properties:
+            self.decode_budget = float(properties['rl_decode_budget'])
+        if 'rl_block' in properties:
+            self.block_size = parse_block_size(properties['rl_block'])
+            if self.block_size is None:
+                print("FATAL: rl_block must be one of %s" %
+                      ', '.join('%sx%s' % size for size in BLOCK_SIZES))
+                exit(1)
+        if 'rl_dict_cap' in properties:
+            self.dict_cap = int(properties['rl_dict_cap'])
+            if not 0 < self.dict_cap <= 256:
+                print("FATAL: rl_dict_cap must be between 1 and 256")
+                exit(1)
+        if 'rl_scroll' in properties:
+            self.scroll = parse_scroll(properties['rl_scroll'])
+        if self.compr not in COMPRESSORS and self.compr != 'auto':
             self.compr = None
         if self.segment != 'true':
             self.segment = False
+        if 'rl_obj_grid' in properties:
+            self.object_grid = parse_object_grid(properties['rl_obj_grid'], (self.segment_w, self.segment_h))
+        if 'rl_obj_pack' in properties:
+            self.object_pack = str(properties['rl_obj_pack']).lower() == 'true'
+        if 'rl_collision' in properties:
+            self.collision = str(properties['rl_collision'])
+        if 'rl_tiles' in properties:
+            self.tiles = parse_tile_usage(properties['rl_tiles'])
+        self.collision_classes = tile_collision_classes(raw_map)
         self.tile_layers = []
+        self.collision_layers = []
         self.objectgroup_layers = []
-        self.process_layers()
+        self.object_schema = ObjectSchema()
+        self.process_layers(previous)
 
     def __setitem__(self, key, value):
         self.__dict__[key] = value
@@ -497,65 +2279,144 @@ class TiledMap:
     def __getitem__(self, key):
         return self.__dict__[key]
 
-    def process_layers(self):
+    def process_layers(self, previous=None):
+        """
+        Build the layers of the map. Tile layers reuse the encodings of the
+        layer with the same name in the previous version of the map, if given.
+        """
+        previous_layers = {}
+        if previous is not None:
+            previous_layers = {layer.name: layer for layer in previous.tile_layers}
         for layer in self.raw_layers:
-            if 'tilelayer' in layer['type']:
-                self.tile_layers.append(TileLayer(layer, self.segment_w, self.segment_h, self.compr, self.segment))
+            if 'tilelayer' in layer['type'] and str(get_properties(layer).get('rl_collision')).lower() == 'true':
+                # drawn only for collisions, its tiles are not emitted
+                self.collision_layers.append(self.collision_layer(layer['name'], decode_layer_data(layer)))
+            elif 'tilelayer' in layer['type']:
+                start = time.time()
+                tile_layer = TileLayer(layer, self.segment_w, self.segment_h, self.compr, self.segment,
+                                       self.decode_budget, self.block_size, self.dict_cap,
+                                       self.scroll, self.tiles, previous_layers.get(layer['name']))
+                tile_layer.build_time = time.time() - start
+                self.tile_layers.append(tile_layer)
             elif 'objectgroup' in layer['type']:
-                self.objectgroup_layers.append(ObjectGroupLayer(layer))
+                self.objectgroup_layers.append(ObjectGroupLayer(layer, self.object_layer_grid(layer),
+                                                                self.object_schema))
+        if self.collision is not None:
+            # classes are by GID, so use the tiles as read rather than remapped
+            layers = [layer for layer in self.raw_layers
+                      if 'tilelayer' in layer['type'] and layer['name'] == self.collision]
+            if not layers:
+                print("FATAL: rl_collision names a missing tile layer %s" % self.collision)
+                exit(1)
+            if not self.collision_classes:
+                print("FATAL: rl_collision is set on the map but no tile sets rl_collision")
+                exit(1)
+            self.collision_layers.append(self.collision_layer(self.collision, decode_layer_data(layers[0])))
+
+    def collision_layer(self, name, data):
+        if self.segment:
+            return CollisionLayer(name, self.map_w, self.map_h, data, self.collision_classes,
+                                  self.segment_w, self.segment_h)
+        return CollisionLayer(name, self.map_w, self.map_h, data, self.collision_classes, self.map_w, self.map_h)
+
+    def object_layer_grid(self, layer):
+        """
+        Return the grid indexing the objects of a layer, as (columns, rows,
+        cell width, cell height) with cells in pixels, or None. The layer
+        rl_obj_grid property overrides the map one.
+        """
+        grid = self.object_grid
+        properties = get_properties(layer)
+        if 'rl_obj_grid' in properties:
+            grid = parse_object_grid(properties['rl_obj_grid'], (self.segment_w, self.segment_h))
+        if grid is None:
+            return None
+        cell_w, cell_h = grid
+        # cells are numbered as segments, a partial last row or column joins the previous one
+        return (max(self.map_w // cell_w, 1), max(self.map_h // cell_h, 1), cell_w * self.tile_w, cell_h * self.tile_h)
 
 
 class TileMapWriter:
     """ writes a tile map to set of C header files
     """
 
-    def __init__(self, tilemap, output):
+    def __init__(self, tilemap, output, binary=False, rle_compare=False, stats=False):
         self.tilemap = tilemap
         self.output = output
+        self.binary = binary
+        self.rle_compare = rle_compare
+        self.stats = {'stages': {}, 'layers': {}} if stats else None
         self.block_dict = {}
         filename, file_extension = os.path.splitext(self.output)
         self.filename = filename
         self.basepath = ntpath.basename(self.output)
         basename, base_extension = os.path.splitext(self.basepath)
         self.basename = basename
+        self.outputs = {}
 
-    def extract_properties(self):
-        """
-        Extract properties from all object layers
-        """
-        self.object_properties = {}
-        self.enum_properties = {}
-        self.max_num_properties = {}
-        for object_layer in self.tilemap.objectgroup_layers:
-            for item in object_layer.raw_objects:
-                # find all types or names
-                _type = item['type']
-                if _type == '':
-                    _type = item['name']
-                if 'properties' in item:
-                    # Add properties to dict avoiding repetitions.
-                    if _type in self.object_properties:
-                        already_added = set(self.object_properties[_type])
-                        new_items = set(item['properties'].keys())
-                        to_be_added = new_items - already_added
-                        self.object_properties[_type] = self.object_properties[_type] + list(to_be_added)
-                    else:
-                        self.object_properties[_type] = list(item['properties'].keys())
-                    length = len(list(item['properties'].keys()))
-                    for _property in list(item['properties'].keys()):
-                        value = item['properties'][_property]
-                        if (not value.isdigit() and not value.replace('.', '').isdigit()):
-                            if not _property in self.enum_properties:
-                                self.enum_properties[_property] = {}
-                            self.enum_properties[_property][value.encode('ascii', 'ignore')] = '1'
+    def open_output(self, suffix, binary=False):
+        """
+        Return a buffer for the output file with the given suffix, files are
+        only written to disk by write_outputs
+        """
+        fout = io.BytesIO() if binary else io.StringIO()
+        self.outputs[self.filename + suffix] = fout
+        return fout
+
+    def output_contents(self):
+        return {path: fout.getvalue() for path, fout in self.outputs.items()}
+
+    def write_outputs(self):
+        """
+        Write all generated files, leaving untouched those that did not change.
+        Returns the number of files written.
+        """
+        written = 0
+        for path, content in self.output_contents().items():
+            written += write_if_changed(path, content)
+        return written
+
+    def stage(self, name, func):
+        """
+        Run a stage of the header generation, timing it if collecting stats
+        """
+        start = time.time()
+        func()
+        if self.stats is not None:
+            self.stats['stages'][name] = time.time() - start
+
+    def infer_object_packing(self):
+        """
+        Infer the bit widths of the object fields of the map, if packed
+        """
+        self.object_packing = None
+        if self.tilemap.object_pack:
+            self.object_packing = ObjectPacking(self.tilemap.object_schema)
 
     def generate_headers(self):
-        self.extract_properties()
-        self.write_definitions()
-        self.write_initialization()
-        self.write_tilelayers()
-        self.write_objectgroup_layers()
-        self.write_grouping_header()
+        self.stage('object_packing', self.infer_object_packing)
+        self.stage('definitions', self.write_definitions)
+        self.stage('initialization', self.write_initialization)
+        self.stage('tilelayers', self.write_tilelayers)
+        self.stage('collision', self.write_collision_layers)
+        self.stage('objectgroups', self.write_objectgroup_layers)
+        self.stage('grouping', self.write_grouping_header)
+        if self.stats is not None:
+            self.write_stats()
+        written = self.write_outputs()
+        if self.rle_compare:
+            for layer in self.tilemap.tile_layers:
+                layer.dump_rle_comparison()
+        return written
+
+    def write_stats(self):
+        """
+        Write the timings and sizes collected during the generation as json,
+        for the build to aggregate them across maps
+        """
+        stats = dict(self.stats, map=self.basename)
+        stats['total_size'] = sum(layer['total_size'] for layer in stats['layers'].values()) + stats['objects_size']
+        json.dump(stats, self.open_output('_stats.json'), indent=1)
 
     def write_initialization(self):
         """
@@ -565,7 +2426,7 @@ class TileMapWriter:
         basepath = ntpath.basename(self.output)
         basename, base_extension = os.path.splitext(basepath)
 
-        fout = open(filename + '_init.h', 'w+')
+        fout = self.open_output('_init.h')
         basename = basename + '_init'
 
         print(("#ifndef __MAP_INIT_H"), file=fout)
@@ -590,7 +2451,15 @@ class TileMapWriter:
                   file=fout)
             layer_count = layer_count + 1
         print(("}"), file=fout)
+        body = []
         for layer in self.tilemap.tile_layers:
+            body += layer.dump_as_c_header_accessor(fout, self.basename)
+        if body:
+            print(("void init_%s_tilelayers(void) {" % self.basename), file=fout)
+            for line in body:
+                print(line, file=fout)
+            print(("}"), file=fout)
+        for layer in self.tilemap.collision_layers:
             layer.dump_as_c_header_accessor(fout, self.basename)
 
         print(("#endif"), file=fout)
@@ -603,7 +2472,7 @@ class TileMapWriter:
         basepath = ntpath.basename(self.output)
         basename, base_extension = os.path.splitext(basepath)
 
-        fout = open(filename + '.h', 'w+')
+        fout = self.open_output('.h')
 
         print(("#ifndef __MAP_DATA_H"), file=fout)
         print(("#define __MAP_DATA_H"), file=fout)
@@ -612,6 +2481,10 @@ class TileMapWriter:
             header = basename + '_layer_' + layer.name + '.h'
             print(("#include \"%s\"" % header), file=fout)
 
+        for layer in self.tilemap.collision_layers:
+            header = basename + '_layer_' + layer.name + '_collision.h'
+            print(("#include \"%s\"" % header), file=fout)
+
         header = basename + '_layer_objects.h'
         print(("#include \"%s\"" % header), file=fout)
 
@@ -627,7 +2500,7 @@ class TileMapWriter:
         basepath = ntpath.basename(self.output)
         basename, base_extension = os.path.splitext(basepath)
 
-        fout = open(filename + '_defs.h', 'w+')
+        fout = self.open_output('_defs.h')
         basename = basename + '_defs'
 
         print(("/* --- THIS FILE IS GENERATED, DO NOT EDIT --- */"), file=fout)
@@ -650,29 +2523,45 @@ class TileMapWriter:
             layer.dump_as_c_header_no_data(fout, self.basename)
             print(("#endif"), file=fout)
 
-        if len(list(self.object_properties.keys())) > 0:
+        ## Collision layers
+        #
+        for layer in self.tilemap.collision_layers:
+            basename, base_extension = os.path.splitext(basepath)
+            basename = basename + '_layer_' + layer.name + '_collision'
+            print(("#ifndef __MAP_DATA_%s_H" % basename.upper()), file=fout)
+            layer.dump_as_c_header_no_data(fout, self.basename)
+            print(("#endif"), file=fout)
+
+        ## Compression mode of each tile layer, to pick the matching decoder
+        #
+        for layer in self.tilemap.tile_layers:
+            layer.dump_mode(fout, self.basename)
+
+        schema = self.tilemap.object_schema
+        if len(schema.types) > 0:
             print(("\nenum %s_object_type {" % self.basename), file=fout)
-            for key in list(self.object_properties.keys()):
+            for key in schema.types:
                 print(("    %s, " % key.upper()), file=fout)
             print(("};\n"), file=fout)
 
             ## enum_properties
-            for key in self.enum_properties:
+            for key in schema.enums:
                 print(("\nenum %s_object_property_%s {" % (self.basename, key)), file=fout)
-                for _property in self.enum_properties[key]:
-                    print(("    %s_%s, " % (key.upper(), _property.decode('ascii').upper())), file=fout, flush=True)
-                print(("};\n"), file=fout, flush=True)
+                for _property in schema.enums[key]:
+                    print(("    %s_%s, " % (key.upper(), _property.encode('ascii', 'ignore').decode('ascii').upper())),
+                          file=fout)
+                print(("};\n"), file=fout)
 
         ## now additional structures and unions...
-        for key in list(self.object_properties.keys()):
+        for key in schema.types:
             ## here keys and properties cannot be C keywords
             print(("struct %s_object_%s {" % (self.basename, key)), file=fout)
-            if len(self.object_properties[key]) > 0:
-                for _property in self.object_properties[key]:
+            if len(schema.types[key]) > 0:
+                for _property in schema.types[key]:
                     ## TODO filter C Keywords
                     if _property == 'static':
                         _property = 'static_'
-                    if _property in self.enum_properties:
+                    if _property in schema.enums:
                         print(("     enum %s_object_property_%s %s;" % (self.basename, _property, _property)),
                               file=fout)
                     else:
@@ -681,9 +2570,9 @@ class TileMapWriter:
                 print(("     unsigned char dummy;"), file=fout)
             print(("};\n"), file=fout)
 
-        if len(list(self.object_properties.keys())) > 0:
+        if len(schema.types) > 0:
             print(("union %s_object {" % self.basename), file=fout)
-            for key in list(self.object_properties.keys()):
+            for key in schema.types:
                 if key == "static":
                     _key = "static_"
                 else:
@@ -691,6 +2580,9 @@ class TileMapWriter:
                 print(("    struct %s_object_%s %s;" % (self.basename, key, _key)), file=fout)
             print(("};"), file=fout)
 
+        if self.object_packing is not None:
+            self.object_packing.dump_accessors(fout, self.basename)
+
         print(("struct %s_object_item {" % self.basename), file=fout)
         print(("    enum %s_object_type type;" % self.basename), file=fout)
         print(("    unsigned char x;"), file=fout)
@@ -698,7 +2590,7 @@ class TileMapWriter:
         print(("    unsigned char w;"), file=fout)
         print(("    unsigned char h;"), file=fout)
         print(("    unsigned char visible;"), file=fout)
-        if len(list(self.object_properties.keys())) > 0:
+        if len(schema.types) > 0:
             print(("    union %s_object object;" % self.basename), file=fout)
         print("};\n", file=fout)
 
@@ -715,17 +2607,44 @@ class TileMapWriter:
         ## Fist write data
         ##
         for layer in self.tilemap.tile_layers:
-            fout = open(filename + '_layer_' + layer.name + '.h', 'w+')
+            start = time.time()
+            fout = self.open_output('_layer_' + layer.name + '.h')
             basename = basename + '_layer_' + layer.name
 
             print(("#ifndef __MAP_DATA_%s_H" % basename.upper()), file=fout)
             print(("#define __MAP_DATA_%s_H" % basename.upper()), file=fout)
 
-            size = layer.dump_as_c_header(fout, self.basename)
+            if self.binary:
+                size, payloads = layer.dump_as_binary(fout, self.basename)
+                for symbol, ctype, data in payloads:
+                    self.open_output(symbol[len(self.basename):] + '.bin', binary=True).write(data)
+            else:
+                size = layer.dump_as_c_header(fout, self.basename)
             if size > 8192:
                 print("FATAL: map file bigger than 8k")
                 exit(1)
             print("#endif", file=fout)
+            if self.stats is not None:
+                self.stats['layers'][layer.name] = dict(layer.encoding_stats(), total_size=size,
+                                                        build=getattr(layer, 'build_time', 0.0),
+                                                        write=time.time() - start)
+
+    def write_collision_layers(self):
+        """
+        Write a header file for every collision layer
+        """
+        for layer in self.tilemap.collision_layers:
+            fout = self.open_output('_layer_' + layer.name + '_collision.h')
+            guard = '__MAP_DATA_%s_LAYER_%s_COLLISION_H' % (self.basename.upper(), layer.name.upper())
+            print(("#ifndef %s" % guard), file=fout)
+            print(("#define %s" % guard), file=fout)
+            size = layer.dump_as_c_header(fout, self.basename)
+            print("#endif", file=fout)
+            if self.stats is not None:
+                self.stats['layers'][layer.name + '_collision'] = {'mode': 'collision', 'bits': layer.bits,
+                                                                   'total_size': size,
+                                                                   'segments': [len(packed) for packed in
+                                                                                layer.segments]}
 
     def write_objectgroup_layers(self):
         """
@@ -737,7 +2656,7 @@ class TileMapWriter:
 
         ## First write data
         #
-        fout = open(filename + '_layer_objects.h', 'w+')
+        fout = self.open_output('_layer_objects.h')
         basename = basename + '_layer_objects'
 
         print(("#ifndef __MAP_DATA_%s_H" % basename.upper()), file=fout)
@@ -745,14 +2664,87 @@ class TileMapWriter:
 
         size = 0
         for layer in self.tilemap.objectgroup_layers:
-            size += layer.dump_as_c_header(fout, self.basename, self.object_properties)
+            size += layer.dump_as_c_header(fout, self.basename, self.object_packing)
         if size > 8192:
             print("FATAL: map file bigger than 8k")
             exit(1)
+        if self.stats is not None:
+            self.stats['objects_size'] = size
 
         print("#endif", file=fout)
 
 
+class MapCache:
+    """
+    Content addressed cache of generated headers.
+
+    Entries are keyed on a hash of the source json, the options affecting the
+    output and the tool itself, and hold the contents of every generated file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.stats_file = os.path.join(self.path, 'stats.json')
+
+    def key(self, source, options):
+        digest = hashlib.sha1()
+        with open(os.path.abspath(__file__), 'rb') as f:
+            digest.update(f.read())
+        digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def entry_file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def restore(self, key):
+        """
+        Restore the outputs of a cache entry, returns the entry or None on a miss
+        """
+        try:
+            with open(self.entry_file(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry['written'] = 0
+        for path, content in entry['outputs'].items():
+            if isinstance(content, dict):
+                content = base64.b64decode(content['base64'])
+            if write_if_changed(path, content):
+                entry['written'] += 1
+        return entry
+
+    def store(self, key, outputs, elapsed):
+        outputs = {path: {'base64': base64.b64encode(content).decode('ascii')} if isinstance(content, bytes)
+                   else content for path, content in outputs.items()}
+        entry = {'outputs': outputs, 'time': elapsed}
+        tmp_file = self.entry_file(key) + '.%d' % os.getpid()
+        with open(tmp_file, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, self.entry_file(key))
+
+    def account(self, hits=0, misses=0, saved=0.0):
+        """
+        Update the persistent hit/miss counters, returns them
+        """
+        stats = {'hits': 0, 'misses': 0, 'saved': 0.0}
+        try:
+            with open(self.stats_file) as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        stats['hits'] += hits
+        stats['misses'] += misses
+        stats['saved'] += saved
+        tmp_file = self.stats_file + '.%d' % os.getpid()
+        with open(tmp_file, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp_file, self.stats_file)
+        return stats
+
+
 class TiledMapJsonReader:
     """ reads a json file saved from tiled"""
 
@@ -760,25 +2752,259 @@ class TiledMapJsonReader:
         self.filename = filename
 
     def read(self):
+        start = time.time()
         self.data = open(self.filename)
         self.decoded = json.load(self.data)
-        return TiledMap(self.decoded)
+        parsed = time.time()
+        tilemap = TiledMap(self.decoded)
+        self.timings = {'parse': parsed - start, 'layers': time.time() - parsed}
+        return tilemap
+
+
+def convert_map(source, output, cache=None, options=None):
+    """
+    Convert a single Tiled map to C headers, going through the cache if given.
+    options are passed to TileMapWriter. Returns a (hit, elapsed) tuple,
+    elapsed being the generation time saved on a hit or spent on a miss.
+    """
+    options = options or {}
+    if cache:
+        key = cache.key(source, dict(options, output=output))
+        entry = cache.restore(key)
+        if entry is not None:
+            print("map cache hit: %s (%d of %d files updated, saved %.2fs)" %
+                  (source, entry['written'], len(entry['outputs']), entry['time']))
+            return True, entry['time']
+
+    start = time.time()
+    reader = TiledMapJsonReader(source)
+    writer = TileMapWriter(reader.read(), output, **options)
+    if writer.stats is not None:
+        writer.stats['stages'].update(reader.timings)
+
+    writer.generate_headers()
+
+    elapsed = time.time() - start
+    if cache:
+        cache.store(key, writer.output_contents(), elapsed)
+        print("map cache miss: %s (%.2fs)" % (source, elapsed))
+    return False, elapsed
+
+
+def convert_map_job(job):
+    """
+    Process pool entry point: converts one map isolating any failure.
+    Returns (source, log, hit, elapsed, ok).
+    """
+    source, output, cache_path, options = job
+    log = io.StringIO()
+    hit, elapsed, ok = False, 0.0, True
+    try:
+        with redirect_stdout(log):
+            hit, elapsed = convert_map(source, output, MapCache(cache_path) if cache_path else None, options)
+    except SystemExit as e:
+        ok = not e.code
+    except Exception as e:
+        print("%s: %s" % (type(e).__name__, e), file=log)
+        ok = False
+    return source, log.getvalue(), hit, elapsed, ok
+
+
+def disable_numpy():
+    global numpy
+    numpy = None
+
+
+def read_manifest(manifest):
+    """
+    Read a batch manifest: one map per line as 'source [output]', relative to
+    the manifest location. Empty lines and lines starting with # are ignored.
+    """
+    jobs = []
+    base = os.path.dirname(manifest)
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            source = os.path.join(base, fields[0])
+            output = os.path.join(base, fields[1]) if len(fields) > 1 else None
+            jobs.append((source, output))
+    return jobs
+
+
+def convert_batch(jobs, cache_path=None, workers=None, no_numpy=False, options=None):
+    """
+    Convert many maps in a single process pool, jobs being (source, output)
+    pairs converted with the same writer options. Failures do not stop the batch, they are reported together at the
+    end. Returns the list of sources that failed.
+    """
+    failed = []
+    hits = misses = 0
+    saved = 0.0
+    initializer = disable_numpy if no_numpy else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as pool:
+        pool_jobs = [(source, output, cache_path, options) for source, output in jobs]
+        for source, log, hit, elapsed, ok in pool.map(convert_map_job, pool_jobs):
+            sys.stdout.write(log)
+            if not ok:
+                failed.append((source, log))
+            elif hit:
+                hits += 1
+                saved += elapsed
+            else:
+                misses += 1
+    if cache_path:
+        stats = MapCache(cache_path).account(hits, misses, saved)
+        print("map cache: %d hits %d misses %.2fs saved (total %d hits %d misses %.2fs saved)" %
+              (hits, misses, saved, stats['hits'], stats['misses'], stats['saved']))
+    print("converted %d of %d maps" % (len(jobs) - len(failed), len(jobs)))
+    if failed:
+        print("FAILED:")
+        for source, log in failed:
+            print("  %s" % source)
+            for line in log.splitlines():
+                print("    %s" % line)
+    return [source for source, log in failed]
+
+
+class MapWatcher:
+    """
+    Watches a directory of Tiled maps and regenerates the headers of those
+    that change. Parsed maps are kept in memory, so unchanged layers and
+    segments reuse their encodings and only changed headers are written.
+    """
+
+    def __init__(self, directory, output_dir, options=None, interval=0.5):
+        self.directory = directory
+        self.output_dir = output_dir
+        self.options = options or {}
+        self.interval = interval
+        self.mtimes = {}
+        self.tilemaps = {}
+
+    def output(self, source):
+        name = os.path.splitext(ntpath.basename(source))[0]
+        return os.path.join(self.output_dir, name + '.h')
+
+    def update(self, source):
+        start = time.time()
+        with open(source) as f:
+            raw = json.load(f)
+        tilemap = TiledMap(raw, self.tilemaps.get(source))
+        writer = TileMapWriter(tilemap, self.output(source), **self.options)
+        written = writer.generate_headers()
+        self.tilemaps[source] = tilemap
+        layers = tilemap.tile_layers
+        print("map updated: %s (%d of %d files written, %d of %d layers and %d segments reused, %.2fs)" %
+              (source, written, len(writer.outputs), sum(layer.reused_layer for layer in layers), len(layers),
+               sum(layer.reused_rooms for layer in layers), time.time() - start))
+
+    def poll(self):
+        """
+        Regenerate the maps changed since the last poll
+        """
+        sources = sorted(glob.glob(os.path.join(self.directory, '*.json')))
+        for source in sources:
+            try:
+                mtime = os.stat(source).st_mtime
+            except OSError:
+                continue
+            if self.mtimes.get(source) == mtime:
+                continue
+            try:
+                self.update(source)
+            except ValueError as e:
+                # Tiled may still be writing the file, try again on the next poll
+                print("map not ready: %s (%s)" % (source, e))
+                continue
+            except SystemExit:
+                print("map failed: %s" % source)
+            except Exception as e:
+                # a map Tiled is still saving may be incomplete in many ways,
+                # report it and keep watching, a new save changes its mtime
+                print("map failed: %s (%s: %s)" % (source, type(e).__name__, e))
+            self.mtimes[source] = mtime
+        for source in set(self.mtimes) - set(sources):
+            del self.mtimes[source]
+            self.tilemaps.pop(source, None)
+
+    def run(self):
+        print("watching %s, press Ctrl-C to stop" % self.directory)
+        try:
+            while True:
+                self.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == '__main__':
 
-    parser = OptionParser()
+    parser = OptionParser(usage="%prog -s source -o output | %prog [-m manifest] [-d dir] [source ...] | "
+                                "%prog -w dir -d dir")
     parser.add_option("-s", "--source", dest="source", action="store", default=None,
                       help="Source json file containing the tilemap")
     parser.add_option("-o", "--output", dest="output", action="store", default=None,
                       help="Basename of output header files containing the data")
+    parser.add_option("-c", "--cache", dest="cache", action="store", default=None,
+                      help="Directory holding the cache of generated headers")
+    parser.add_option("-m", "--manifest", dest="manifest", action="store", default=None,
+                      help="Batch mode: file listing 'source [output]' maps to convert")
+    parser.add_option("-d", "--output-dir", dest="output_dir", action="store", default=None,
+                      help="Batch mode: directory for outputs of maps given without one")
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=None,
+                      help="Batch mode: number of worker processes (defaults to the number of cores)")
+    parser.add_option("--rle-compare", dest="rle_compare", action="store_true", default=False,
+                      help="Print the size of the greedy and optimal RLE encodings of every tile layer")
+    parser.add_option("-b", "--binary", dest="binary", action="store_true", default=False,
+                      help="Write tile layer data as raw .bin blobs instead of C arrays")
+    parser.add_option("--no-numpy", dest="no_numpy", action="store_true", default=False,
+                      help="Use the pure Python encoders even if NumPy is available")
+    parser.add_option("--stats", "--profile", dest="stats", action="store_true", default=False,
+                      help="Write the time spent per stage and layer and the size of every layer, segment and "
+                           "dictionary to <output>_stats.json")
+    parser.add_option("-w", "--watch", dest="watch", action="store", default=None,
+                      help="Watch mode: regenerate the maps of this directory into the output dir when they change")
+    parser.add_option("--interval", dest="interval", action="store", type="float", default=0.5,
+                      help="Watch mode: seconds between checks for changed maps")
 
     (opts, args) = parser.parse_args()
+    if opts.no_numpy:
+        numpy = None
+    options = {'binary': opts.binary, 'rle_compare': opts.rle_compare, 'stats': opts.stats}
+
+    if opts.watch:
+        if not opts.output_dir:
+            print("required output dir")
+            sys.exit(1)
+        MapWatcher(opts.watch, opts.output_dir, options, opts.interval).run()
+        sys.exit(0)
+
+    if opts.manifest or args:
+        jobs = read_manifest(opts.manifest) if opts.manifest else []
+        jobs += [(source, None) for source in args]
+        for idx, (source, output) in enumerate(jobs):
+            if output is None:
+                if not opts.output_dir:
+                    print("required output dir for %s" % source)
+                    sys.exit(1)
+                name = os.path.splitext(ntpath.basename(source))[0]
+                jobs[idx] = (source, os.path.join(opts.output_dir, name + '.h'))
+        outputs = [os.path.abspath(output) for source, output in jobs]
+        if len(set(outputs)) != len(outputs):
+            print("FATAL: several maps share the same output")
+            sys.exit(1)
+        failed = convert_batch(jobs, opts.cache, opts.jobs, opts.no_numpy, options)
+        sys.exit(1 if failed else 0)
+
     if not opts.source:
         print("required source")
         sys.exit(1)
 
-    reader = TiledMapJsonReader(opts.source)
-    writer = TileMapWriter(reader.read(), opts.output)
-
-    writer.generate_headers()
+    cache = MapCache(opts.cache) if opts.cache else None
+    hit, elapsed = convert_map(opts.source, opts.output, cache, options)
+    if cache:
+        stats = cache.account(hits=int(hit), misses=int(not hit), saved=elapsed if hit else 0.0)
+        print("map cache: total %d hits %d misses %.2fs saved" % (stats['hits'], stats['misses'], stats['saved']))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Copyright (C) 2017 Enric Martin Geijo (retrodeluxemsx@gmail.com)
+#
+#   RDLEngine is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, version 2.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   this program; If not, see <http://www.gnu.org/licenses/>.
+#
+import glob
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import map2header
+from map2header import BLOCK_INDEX_BYTE, BLOCK_INDEX_NAMES, COMPRESSORS, TileLayer, TiledMapJsonReader, Z80CostModel
+
+
+class MapBenchmark:
+    """
+    Runs every compression mode of map2header over the tile layers of a map
+    """
+
+    def __init__(self, filename, repeat):
+        self.filename = filename
+        self.repeat = repeat
+        self.results = []
+        self.model = Z80CostModel()
+
+    def variants(self):
+        for compr in COMPRESSORS:
+            for segment in (False, 'true'):
+                yield compr, segment
+
+    def run(self):
+        reader = TiledMapJsonReader(self.filename)
+        tilemap = reader.read()
+        for raw in tilemap.raw_layers:
+            if 'tilelayer' not in raw['type']:
+                continue
+            raw_size = raw['width'] * raw['height']
+            for compr, segment in self.variants():
+                best = None
+                for i in range(self.repeat):
+                    # a fresh layer each time, encodings are cached per layer
+                    start = time.perf_counter()
+                    layer = TileLayer(raw, tilemap.segment_w, tilemap.segment_h, compr, segment,
+                                      block_size=tilemap.block_size, dict_cap=tilemap.dict_cap)
+                    payloads = layer.binary_payloads('bench')
+                    elapsed = time.perf_counter() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                size = sum(len(data) for symbol, ctype, data in payloads)
+                dict_sizes = [len(block_dict) for block_dict in layer.dictionaries()]
+                block_index = None
+                if layer.mode == 2:
+                    block_index = BLOCK_INDEX_NAMES[layer.compr_blocks[0]]
+                elif layer.mode == 4:
+                    block_index = BLOCK_INDEX_NAMES[layer.rooms_compr_blocks[0]]
+                elif layer.mode == 8:
+                    block_index = BLOCK_INDEX_NAMES[BLOCK_INDEX_BYTE]
+                decode_full, decode_screen = layer.decode_cost(self.model)
+                greedy_size = None
+                if compr == 'rle':
+                    greedy, greedy_rooms = layer.rle_greedy_sizes()
+                    # terminators included, whole map streams are emitted as words
+                    if segment:
+                        greedy_size = greedy_rooms + len(payloads)
+                    else:
+                        greedy_size = (greedy + 1) * 2
+                self.results.append({
+                    'map': self.filename,
+                    'layer': layer.name,
+                    'compr': compr,
+                    'segment': bool(segment),
+                    'mode': layer.mode,
+                    'time': best,
+                    'raw_bytes': raw_size,
+                    'bytes': size,
+                    'ratio': raw_size / size if size else 0.0,
+                    'rle_greedy_bytes': greedy_size,
+                    'payloads': len(payloads),
+                    'dict_blocks': sum(dict_sizes),
+                    'dict_max': max(dict_sizes) if dict_sizes else 0,
+                    'block_index': block_index,
+                    'decode_ok': layer.verify(),
+                    'decode_tstates': decode_full,
+                    'decode_frames': self.model.frames(decode_full),
+                    'screen_tstates': decode_screen,
+                    'screen_frames': self.model.frames(decode_screen),
+                })
+        return self.results
+
+
+def discover_maps(top):
+    """
+    Find all Tiled maps of the roms and tests under top
+    """
+    maps = []
+    for tree in ('roms', 'test'):
+        maps += glob.glob(os.path.join(top, tree, '*', 'res', 'map', '*.json'))
+    return sorted(maps)
+
+
+def print_table(results):
+    print("%-44s %-10s %-6s %-3s %9s %6s %6s %6s %6s %7s %7s %3s" %
+          ("map", "layer", "compr", "seg", "time(ms)", "raw", "bytes", "ratio", "dict", "frames", "screen", "ok"))
+    for res in results:
+        dict_info = '-'
+        if res['dict_blocks']:
+            # a letter marks dictionaries indexed other than by bytes
+            dict_info = "%d%s" % (res['dict_max'], '' if res['block_index'] == 'byte' else res['block_index'][0])
+        print("%-44s %-10s %-6s %-3s %9.2f %6d %6d %6.2f %6s %7.2f %7.2f %3s" %
+              (res['map'], res['layer'][:10], res['compr'], 'yes' if res['segment'] else 'no',
+               res['time'] * 1000, res['raw_bytes'], res['bytes'], res['ratio'], dict_info,
+               res['decode_frames'], res['screen_frames'], 'yes' if res['decode_ok'] else 'NO'))
+
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage="%prog [options] [map.json ...]")
+    parser.add_option("-t", "--top", dest="top", action="store",
+                      default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      help="Root of the tree searched for maps when none are given")
+    parser.add_option("-r", "--repeat", dest="repeat", action="store", type="int", default=3,
+                      help="Number of runs per encoding, the fastest one is reported")
+    parser.add_option("-j", "--json", dest="json", action="store", default=None,
+                      help="Write the results as json to this file")
+    parser.add_option("--no-numpy", dest="no_numpy", action="store_true", default=False,
+                      help="Use the pure Python encoders even if NumPy is available")
+
+    (opts, args) = parser.parse_args()
+    if opts.no_numpy:
+        map2header.numpy = None
+
+    maps = args if args else discover_maps(opts.top)
+    if not maps:
+        print("no maps found")
+        sys.exit(1)
+
+    results = []
+    for filename in maps:
+        results += MapBenchmark(filename, opts.repeat).run()
+    for res in results:
+        res['map'] = os.path.relpath(res['map'], opts.top)
+
+    print_table(results)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump({'numpy': map2header.numpy is not None, 'results': results}, f, indent=2)
@@ -1,10 +1,36 @@
-#!/usr/bin/env python2.7
-import json
+#!/usr/bin/env python3
 import sys
 import os
 import ntpath
 from optparse import OptionParser
 
+FADE_TARGETS = {
+    'black': {'r': 0, 'g': 0, 'b': 0},
+    'white': {'r': 7, 'g': 7, 'b': 7},
+}
+
+def vdp_color(color):
+    """ packs a 9-bit color in the two byte format of the VDP palette port:
+        0RRR0BBB, 00000GGG """
+    return [(color['r'] << 4) | color['b'], color['g']]
+
+def interpolate(source, target, step, steps):
+    """ returns the palette at the given step of a linear transition from
+        source to target, step 0 being source and step 'steps' target """
+    pal = []
+    for i, color in enumerate(source):
+        dest = target[i] if isinstance(target, list) else target
+        pal.append(dict((c, (color[c] * (steps - step) + dest[c] * step
+                             + steps // 2) // steps) for c in 'rgb'))
+    return pal
+
+def open_header(output):
+    """ opens the header written for output, whose extension is replaced by
+        .h, and returns it with the basename naming its symbols """
+    filename, file_extension = os.path.splitext(output)
+    basename, base_extension = os.path.splitext(ntpath.basename(output))
+    return open(filename + '.h', 'w+'), basename
+
 class PaletteReader:
     """ reads a GIMP palette file in txt format """
     def __init__(self, filename):
@@ -17,39 +43,181 @@ class PaletteReader:
         lines = file.readlines()
         for line in lines:
             # extract and transform to 9-rgb
-            r = int(line[1:2], 16) / 2
-            g = int(line[3:4], 16) / 2
-            b = int(line[5:6], 16) / 2
+            r = int(line[1:2], 16) // 2
+            g = int(line[3:4], 16) // 2
+            b = int(line[5:6], 16) // 2
             self.pal.append({'r': r, 'g' : g, 'b': b})
             self.color = self.color + 1
 
-    def write(self, output):
-        filename, file_extension = os.path.splitext(output)
-        basepath = ntpath.basename(output)
-        basename, base_extension = os.path.splitext(basepath)
-        fout = open(filename + '.h', 'w+')
+    def transition(self, target, steps):
+        """ returns the steps + 1 palettes of a transition towards target, a
+            single color or a palette, packed in VDP format """
+        if isinstance(target, list) and len(target) != len(self.pal):
+            print("FATAL: cannot transition between palettes of %d and %d colors"
+                  % (len(self.pal), len(target)))
+            exit(1)
+        table = []
+        for step in range(steps + 1):
+            for color in interpolate(self.pal, target, step, steps):
+                table.extend(vdp_color(color))
+        return table
 
-        print >>fout,("#ifndef __PALETTE_%s_H" % basename.upper())
-        print >>fout,("#define __PALETTE_%s_H" % basename.upper())
-        print >>fout,("const uint8_t %s_palette[] = {" % basename)
+    def dump_table(self, fout, name, table):
+        size = len(self.pal) * 2
+        print("const uint8_t %s[] = {" % name, file=fout)
+        for i in range(0, len(table), size):
+            print(",".join(str(x) for x in table[i:i + size]) + ",", file=fout)
+        print("};", file=fout)
+
+    def write(self, output, fades=(), targets=(), steps=8):
+        """ writes the palette header, optionally followed by fade and
+            transition tables of steps + 1 palettes of 2 bytes per color
+            ready to be copied to the VDP palette port """
+        fout, basename = open_header(output)
+
+        print("#ifndef __PALETTE_%s_H" % basename.upper(), file=fout)
+        print("#define __PALETTE_%s_H" % basename.upper(), file=fout)
+        print("const uint8_t %s_palette[] = {" % basename, file=fout)
         for color in self.pal:
-            print >>fout,("%d,%d,%d," % (color['r'], color['g'], color['b']))
-        print >>fout,"};"
-        print >>fout,"#endif"
+            print("%d,%d,%d," % (color['r'], color['g'], color['b']), file=fout)
+        print("};", file=fout)
+        if fades or targets:
+            print("#define %s_PALETTE_SIZE %d" % (basename.upper(), len(self.pal) * 2), file=fout)
+            print("#define %s_FADE_STEPS %d" % (basename.upper(), steps), file=fout)
+        for fade in fades:
+            self.dump_table(fout, "%s_fade_%s" % (basename, fade),
+                self.transition(FADE_TARGETS[fade], steps))
+        for target in targets:
+            other = PaletteReader(target)
+            other.read()
+            name = os.path.splitext(ntpath.basename(target))[0]
+            self.dump_table(fout, "%s_to_%s" % (basename, name),
+                self.transition(other.pal, steps))
+        print("#endif", file=fout)
+        fout.close()
+
+def overlap(head, tail):
+    """ returns the number of colors at the end of head that start tail """
+    for size in range(min(len(head), len(tail)) - 1, 0, -1):
+        if head[-size:] == tail[:size]:
+            return size
+    return 0
+
+def find(data, pal):
+    """ returns the position of the color sequence pal within data """
+    for pos in range(len(data) - len(pal) + 1):
+        if data[pos:pos + len(pal)] == pal:
+            return pos
+    return None
+
+class PaletteBatch:
+    """ merges many palettes in a single color array, where identical
+        palettes, palettes contained in others and overlapping ends of
+        palettes are stored once """
+    def __init__(self, filenames):
+        self.names = []
+        self.pals = []
+        for filename in filenames:
+            name = os.path.splitext(ntpath.basename(filename))[0]
+            if name in self.names:
+                print("FATAL: palette name %s is used by several sources" % name)
+                exit(1)
+            reader = PaletteReader(filename)
+            reader.read()
+            self.names.append(name)
+            self.pals.append([(c['r'], c['g'], c['b']) for c in reader.pal])
+        self.data = []
+        self.offsets = []
+
+    def merge(self):
+        seqs = []
+        for pal in self.pals:
+            if pal and pal not in seqs:
+                seqs.append(pal)
+        seqs = [s for s in seqs if not any(o is not s and find(o, s) is not None for o in seqs)]
+        # greedy shortest common superstring, joining the pair that shares
+        # the most colors first
+        while len(seqs) > 1:
+            best = (0, 0, 1)
+            for i, head in enumerate(seqs):
+                for j, tail in enumerate(seqs):
+                    if i != j and overlap(head, tail) > best[0]:
+                        best = (overlap(head, tail), i, j)
+            size, i, j = best
+            merged = seqs[i] + seqs[j][size:]
+            seqs = [s for k, s in enumerate(seqs) if k not in (i, j)]
+            seqs.insert(min(i, j), merged)
+        self.data = seqs[0] if seqs else []
+        self.offsets = [find(self.data, pal) if pal else 0 for pal in self.pals]
+
+    def write(self, output, vdp=False):
+        """ writes a header with the merged colors as r,g,b components or,
+            with vdp, in the two byte format of the palette port, and the
+            tables locating each palette in them """
+        fout, basename = open_header(output)
+        size = 2 if vdp else 3
+
+        print("#ifndef __PALETTE_%s_H" % basename.upper(), file=fout)
+        print("#define __PALETTE_%s_H" % basename.upper(), file=fout)
+        print("#define %s_COUNT %d" % (basename.upper(), len(self.pals)), file=fout)
+        print("#define %s_COLOR_SIZE %d" % (basename.upper(), size), file=fout)
+        for idx, name in enumerate(self.names):
+            print("#define %s_%s %d" % (basename.upper(), name.upper(), idx), file=fout)
+        print("const uint8_t %s_data[] = {" % basename, file=fout)
+        for r, g, b in self.data:
+            color = vdp_color({'r': r, 'g': g, 'b': b}) if vdp else [r, g, b]
+            print(",".join(str(x) for x in color) + ",", file=fout)
+        print("};", file=fout)
+        print("const uint16_t %s_offset[] = {" % basename, file=fout)
+        print(",".join(str(pos * size) for pos in self.offsets) + ",", file=fout)
+        print("};", file=fout)
+        print("const uint8_t %s_colors[] = {" % basename, file=fout)
+        print(",".join(str(len(pal)) for pal in self.pals) + ",", file=fout)
+        print("};", file=fout)
+        print("#define %s_palette(i) (&%s_data[%s_offset[i]])" % (basename, basename, basename), file=fout)
+        print("#endif", file=fout)
+        fout.close()
+
+        total = sum(len(pal) for pal in self.pals) * size
+        print("palettes: %d sources %d bytes, merged %d bytes" % (len(self.pals), total, len(self.data) * size))
 
 if __name__ == '__main__':
 
-    parser = OptionParser()
+    parser = OptionParser(usage="%prog -s source -o output | %prog -o output [--vdp] source ...")
     parser.add_option("-s", "--source", dest="source", action="store", default=None,
                         help="Source file containing the palette")
     parser.add_option("-o", "--output", dest="output", action="store", default=None,
-                        help="Basename of output header files containing the data")
+                        help="Output header file, its extension is replaced by .h in both modes")
+    parser.add_option("-f", "--fade", dest="fades", action="append", default=[],
+                        choices=sorted(FADE_TARGETS),
+                        help="Emit a fade to black or white table, may be repeated")
+    parser.add_option("-t", "--to", dest="targets", action="append", default=[],
+                        help="Emit a transition table to the palette in this file, may be repeated")
+    parser.add_option("-n", "--steps", dest="steps", action="store", type="int", default=8,
+                        help="Number of steps of fade and transition tables")
+    parser.add_option("--vdp", dest="vdp", action="store_true", default=False,
+                        help="Batch mode: store colors in the two byte format of the VDP palette port")
 
     (opts, args) = parser.parse_args()
+    if not opts.output:
+        print ("required output")
+        sys.exit(1)
+    if args:
+        if opts.source or opts.fades or opts.targets:
+            print("FATAL: batch mode takes sources as arguments and does not emit fade tables")
+            sys.exit(1)
+        batch = PaletteBatch(args)
+        batch.merge()
+        batch.write(opts.output, opts.vdp)
+        sys.exit(0)
+
     if not opts.source:
         print ("required source")
         sys.exit(1)
+    if opts.steps < 1:
+        print("FATAL: steps must be at least 1")
+        sys.exit(1)
 
     pal = PaletteReader(opts.source)
     pal.read()
-    pal.write(opts.output)
+    pal.write(opts.output, opts.fades, opts.targets, opts.steps)
@@ -0,0 +1,54 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Helpers to build and run small C programs with the host compiler against
+#   generated headers and engine sources
+#
+import os
+import shutil
+import subprocess
+import unittest
+
+TOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOP = os.path.dirname(TOOLS)
+
+HOSTCC = os.environ.get('HOSTCC', 'gcc')
+
+# SDCC keywords the engine sources use, meaningless on the host
+HOST_DEFINES = ['-D__nonbanked=', '-D__z88dk_fastcall=', '-D__at(x)=', '-D__sfr=', '-D__naked=']
+
+
+def requires_hostcc(test):
+    return unittest.skipUnless(shutil.which(HOSTCC), 'host C compiler %s not found' % HOSTCC)(test)
+
+
+def set_property(raw, name, value):
+    """
+    Set a custom property of a Tiled map, layer or object in the format it
+    already uses
+    """
+    properties = raw.setdefault('properties', {})
+    if isinstance(properties, list):
+        properties[:] = [prop for prop in properties if prop['name'] != name]
+        properties.append({'name': name, 'type': 'string', 'value': value})
+    else:
+        properties[name] = value
+
+
+def run_program(directory, source, sources=(), includes=()):
+    """
+    Build source, written to directory, with the engine sources given and
+    return what it prints. Unused engine functions are dropped at link time,
+    so their dependencies need not be built.
+    """
+    path = os.path.join(directory, 'test.c')
+    with open(path, 'w') as f:
+        f.write(source)
+    binary = os.path.join(directory, 'test')
+    command = [HOSTCC, '-w', '-ffunction-sections', '-fdata-sections', '-Wl,--gc-sections',
+               '-I', os.path.join(TOP, 'engine', 'include'), '-I', directory] + HOST_DEFINES
+    for include in includes:
+        command += ['-I', include]
+    command += ['-o', binary, path] + [os.path.join(TOP, src) for src in sources]
+    subprocess.run(command, check=True)
+    return subprocess.run([binary], check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
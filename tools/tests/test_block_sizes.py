@@ -0,0 +1,73 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Checks that the segment size constants of the block and shared dictionary
+#   compressed tile layers of map2header are declared with a type that holds
+#   them
+#
+import json
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+from hostcc import TOOLS, TOP, set_property
+
+sys.path.insert(0, TOOLS)
+
+import map2header
+
+MAP = os.path.join(TOP, 'test', 'map_test', 'res', 'map', 'map1.json')
+
+SIZE = re.compile(r'const (unsigned char|unsigned int) \w+_segment\d+_size = (\d+);')
+
+CTYPE_MAX = {'unsigned char': 255, 'unsigned int': 65535}
+
+
+def segment_sizes(compr, block):
+    """
+    Return the (ctype, size) of every segment size constant of map1 split in
+    32x24 segments compressed with compr in blocks of the size given
+    """
+    with open(MAP) as f:
+        raw = json.load(f)
+    for name, value in (('rl_compr', compr), ('rl_segment', 'true'), ('rl_seg_w', '32'),
+                        ('rl_seg_h', '24'), ('rl_block', block)):
+        set_property(raw, name, value)
+    with tempfile.TemporaryDirectory() as directory:
+        map2header.TileMapWriter(map2header.TiledMap(raw), os.path.join(directory, 'map.h')).generate_headers()
+        with open(os.path.join(directory, 'map_layer_layer1.h')) as f:
+            return [(ctype, int(size)) for ctype, size in SIZE.findall(f.read())]
+
+
+class BlockSizeTest(unittest.TestCase):
+
+    def check(self, compr, block):
+        sizes = segment_sizes(compr, block)
+        self.assertTrue(sizes)
+        for ctype, size in sizes:
+            self.assertLessEqual(size, CTYPE_MAX[ctype])
+        return sizes
+
+    def test_block_2x1(self):
+        sizes = self.check('block', '2x1')
+        self.assertTrue(any(size > 255 for ctype, size in sizes))
+
+    def test_block(self):
+        for block in ('1x2', '2x2'):
+            with self.subTest(block=block):
+                self.check('block', block)
+
+    def test_shared_2x1(self):
+        sizes = self.check('shared', '2x1')
+        self.assertTrue(any(size > 255 for ctype, size in sizes))
+
+    def test_shared(self):
+        for block in ('1x2', '2x2'):
+            with self.subTest(block=block):
+                self.check('shared', block)
+
+
+if __name__ == '__main__':
+    unittest.main()
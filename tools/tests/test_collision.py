@@ -0,0 +1,132 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Checks the packed collision maps of map2header against the tile classes
+#   they are built from, reading them back as phys_get_collision does
+#
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+
+from hostcc import TOOLS, requires_hostcc, run_program
+
+sys.path.insert(0, TOOLS)
+
+import map2header
+
+CLASSES = {'none': 0, 'solid': 1, 'platform': 2, 'trigger': 3}
+
+
+def make_map(w, h, seg_w, seg_h, classes, dedicated=False, seed=0):
+    """
+    Return a Tiled map with random tiles, whose tileset gives tile n + 1 the
+    collision class classes[n], or a dedicated collision layer
+    """
+    rng = random.Random(seed)
+    data = [rng.randrange(len(classes) + 1) for _ in range(w * h)]
+    layer = {'type': 'tilelayer', 'name': 'bg', 'width': w, 'height': h, 'x': 0, 'y': 0,
+             'opacity': 1, 'visible': True, 'data': data}
+    properties = {'rl_segment': 'true', 'rl_seg_w': str(seg_w), 'rl_seg_h': str(seg_h)}
+    if dedicated:
+        layer['properties'] = {'rl_collision': 'true'}
+        tileset = {'firstgid': 1, 'name': 'tiles'}
+    else:
+        properties['rl_collision'] = 'bg'
+        tileset = {'firstgid': 1, 'name': 'tiles',
+                   'tileproperties': {str(tile): {'rl_collision': name} for tile, name in enumerate(classes)}}
+    raw = {'version': 1, 'orientation': 'orthogonal', 'tilewidth': 8, 'tileheight': 8,
+           'width': w, 'height': h, 'properties': properties, 'tilesets': [tileset], 'layers': [layer]}
+    if dedicated:
+        expected = [1 if tile else 0 for tile in data]
+    else:
+        expected = [CLASSES[classes[tile - 1]] if tile else 0 for tile in data]
+    return raw, expected
+
+
+def get_collision(bitmap, rows, bits, x, y):
+    """ mirror of phys_get_collision """
+    row = rows[y]
+    if bits == 1:
+        return (bitmap[row + (x >> 3)] >> (x & 7)) & 1
+    return (bitmap[row + (x >> 2)] >> ((x & 3) << 1)) & 3
+
+
+def segment_classes(expected, w, seg_w, seg_h, segment):
+    """ classes of the tiles of a segment, row by row """
+    bx, by = segment % (w // seg_w), segment // (w // seg_w)
+    return [expected[(by * seg_h + y) * w + bx * seg_w + x] for y in range(seg_h) for x in range(seg_w)]
+
+
+CASES = [
+    # w, h, seg_w, seg_h, classes, dedicated
+    (64, 32, 32, 16, ['solid', 'platform', 'trigger', 'none'], False),
+    (48, 22, 12, 11, ['solid', 'platform', 'trigger'], False),
+    (40, 20, 20, 10, ['solid', 'none'], False),
+    (36, 18, 9, 9, [], True),
+]
+
+
+class CollisionTest(unittest.TestCase):
+
+    def collision_layers(self):
+        for w, h, seg_w, seg_h, classes, dedicated in CASES:
+            raw, expected = make_map(w, h, seg_w, seg_h, classes, dedicated)
+            tilemap = map2header.TiledMap(raw)
+            self.assertEqual(len(tilemap.collision_layers), 1)
+            yield tilemap, tilemap.collision_layers[0], expected, (w, seg_w, seg_h)
+
+    def test_bits(self):
+        bits = [layer.bits for tilemap, layer, expected, geometry in self.collision_layers()]
+        self.assertEqual(bits, [2, 2, 1, 1])
+
+    def test_lookup(self):
+        for tilemap, layer, expected, (w, seg_w, seg_h) in self.collision_layers():
+            for segment, bitmap in enumerate(layer.segments):
+                with self.subTest(layer=layer.name, w=w, seg_w=seg_w, segment=segment):
+                    self.assertEqual(len(bitmap), layer.stride * seg_h)
+                    found = [get_collision(bitmap, layer.rows, layer.bits, x, y)
+                             for y in range(seg_h) for x in range(seg_w)]
+                    self.assertEqual(found, segment_classes(expected, w, seg_w, seg_h, segment))
+
+    @requires_hostcc
+    def test_phys_get_collision(self):
+        for tilemap, layer, expected, (w, seg_w, seg_h) in self.collision_layers():
+            with self.subTest(w=w, seg_w=seg_w), tempfile.TemporaryDirectory() as directory:
+                writer = map2header.TileMapWriter(tilemap, os.path.join(directory, 'map.h'))
+                writer.generate_headers()
+                header = os.path.join(directory, 'map_layer_%s_collision.h' % layer.name)
+                with open(header) as f:
+                    content = f.read()
+                # int is 16 bits wide on the Z80, as the uint16_t row table of phys
+                with open(header, 'w') as f:
+                    f.write(re.sub(r'\bunsigned int\b', 'uint16_t', content))
+                name = 'map_%s_collision' % layer.name
+                program = '\n'.join([
+                    '#include <stdio.h>',
+                    '#include <stdint.h>',
+                    '#include "phys.h"',
+                    '#include "map_layer_%s_collision.h"' % layer.name,
+                    'static const uint8_t *segments[] = { %s };' % ', '.join(
+                        '%s%s' % (name, segment) for segment in range(len(layer.segments))),
+                    'int main() {',
+                    '  uint8_t segment, x, y;',
+                    '  for (segment = 0; segment < %s; segment++) {' % len(layer.segments),
+                    '    phys_set_collision_map(segments[segment], %s_row, %s);' % (name, layer.bits),
+                    '    for (y = 0; y < %s; y++)' % seg_h,
+                    '      for (x = 0; x < %s; x++)' % seg_w,
+                    '        putchar(\'0\' + phys_get_collision(x, y));',
+                    '    putchar(\'\\n\');',
+                    '  }',
+                    '  return 0;',
+                    '}']) + '\n'
+                output = run_program(directory, program, sources=['engine/phys.c'])
+                self.assertEqual(output.splitlines(), [
+                    ''.join(str(value) for value in segment_classes(expected, w, seg_w, seg_h, segment))
+                    for segment in range(len(layer.segments))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Round trip tests of the LZ tile layer encoder of map2header against its
+#   reference decoder
+#
+import glob
+import json
+import os
+import random
+import sys
+import unittest
+
+TOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS)
+
+import map2header
+from map2header import LZ_MAX_LITERAL, LZ_MAX_MATCH, LZ_MIN_MATCH, LZ_WINDOW, lz_decode
+
+TOP = os.path.dirname(TOOLS)
+
+
+def make_layer():
+    raw = {'name': 'test', 'width': 1, 'height': 1, 'x': 0, 'y': 0,
+           'opacity': 1, 'visible': True, 'data': [0]}
+    return map2header.TileLayer(raw, 1, 1, 'lz', False)
+
+
+def tokens(stream):
+    """ yields (token, offset) of every token of an LZ stream, offset being
+        None for literals """
+    idx = 0
+    while idx < len(stream):
+        token = stream[idx]
+        if token < 0x80:
+            yield token, None
+            idx += 1 + token
+        else:
+            yield token, stream[idx + 1] | stream[idx + 2] << 8
+            idx += 3
+
+
+class LzRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.layer = make_layer()
+
+    def round_trip(self, data):
+        stream = self.layer.compress_lz(data)
+        self.assertEqual(lz_decode(stream), list(data))
+        for token, offset in tokens(stream):
+            self.assertNotEqual(token, 0)
+            if offset is not None:
+                self.assertTrue(1 <= offset <= LZ_WINDOW)
+        return stream
+
+    def test_empty(self):
+        self.assertEqual(self.round_trip([]), [])
+
+    def test_single_tile(self):
+        self.assertEqual(self.round_trip([7]), [1, 7])
+
+    def test_short_buffers(self):
+        for size in range(1, LZ_MIN_MATCH + 3):
+            self.round_trip([5] * size)
+            self.round_trip(list(range(size)))
+
+    def test_long_run(self):
+        stream = self.round_trip([3] * 1000)
+        self.assertIn((0xff, 1), list(tokens(stream)))
+
+    def test_max_literal(self):
+        data = list(range(256)) * 2
+        stream = self.round_trip(data[:LZ_MAX_LITERAL * 2 + 1])
+        self.assertEqual(stream[0], LZ_MAX_LITERAL)
+
+    def test_max_length(self):
+        head = list(range(200))
+        stream = self.round_trip(head + head[:LZ_MAX_MATCH] + [255])
+        self.assertIn((0x80 | (LZ_MAX_MATCH - LZ_MIN_MATCH), len(head)), list(tokens(stream)))
+
+    def test_max_offset(self):
+        rng = random.Random(1)
+        marker = [250, 251, 252, 253]
+        filler = [rng.randrange(200) for _ in range(LZ_WINDOW - len(marker))]
+        stream = self.round_trip(marker + filler + marker)
+        self.assertIn(LZ_WINDOW, [offset for token, offset in tokens(stream)])
+
+    def test_beyond_window(self):
+        rng = random.Random(2)
+        marker = [250, 251, 252, 253]
+        filler = [rng.randrange(200) for _ in range(LZ_WINDOW - len(marker) + 1)]
+        self.round_trip(marker + filler + marker)
+
+    def test_random(self):
+        rng = random.Random(3)
+        for alphabet in (2, 4, 16, 256):
+            for size in (10, 100, 1000, 5000):
+                self.round_trip([rng.randrange(alphabet) for _ in range(size)])
+
+    def test_random_runs(self):
+        rng = random.Random(4)
+        for _ in range(20):
+            data = []
+            while len(data) < 3000:
+                data += [rng.randrange(8)] * rng.choice((1, 2, 3, 4, 130, 131, 300))
+            self.round_trip(data)
+
+    def test_repo_maps(self):
+        maps = glob.glob(os.path.join(TOP, 'test', '*', 'res', 'map', '*.json'))
+        maps += glob.glob(os.path.join(TOP, 'roms', '*', 'res', 'map', '*.json'))
+        self.assertTrue(maps)
+        for path in sorted(maps):
+            with open(path) as f:
+                raw_map = json.load(f)
+            for raw in raw_map['layers']:
+                if raw['type'] != 'tilelayer':
+                    continue
+                with self.subTest(map=os.path.relpath(path, TOP), layer=raw['name']):
+                    self.round_trip(map2header.decode_layer_data(raw))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Checks the bit packed objects of map2header by reading every field back
+#   through the generated C accessors and comparing with the unpacked values
+#
+import glob
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from hostcc import TOOLS, TOP, requires_hostcc, run_program, set_property
+
+sys.path.insert(0, TOOLS)
+
+import map2header
+
+
+def object_maps():
+    maps = glob.glob(os.path.join(TOP, 'test', '*', 'res', 'map', '*.json'))
+    maps += glob.glob(os.path.join(TOP, 'roms', '*', 'res', 'map', '*.json'))
+    for path in sorted(maps):
+        with open(path) as f:
+            raw = json.load(f)
+        if any(layer['type'] == 'objectgroup' and layer['objects'] for layer in raw['layers']):
+            yield path, raw
+
+
+def reader_program(tilemap, packing):
+    """
+    Return a C program printing the type and fields of every packed object
+    of the map, one object per line, through the generated macros
+    """
+    lines = ['#include <stdio.h>',
+             '#include "map_defs.h"',
+             '#include "map_layer_objects.h"',
+             'static void dump(const unsigned char *p) {',
+             '  for (;;) {',
+             '    unsigned char type = map_object_type(p);',
+             '    if (type == (1 << MAP_OBJECT_TYPE_BITS) - 1) break;',
+             '    switch (type) {']
+    for idx, _type in enumerate(packing.types):
+        fields = ['static_' if field == 'static' else field for field in packing.schema.fields(_type)]
+        lines.append('    case %s:' % idx)
+        lines.append('      printf("%%d%s\\n", type, %s);' % (
+            ' %d' * len(fields), ', '.join('map_object_%s_%s(p)' % (_type, field) for field in fields)))
+        lines.append('      p += MAP_OBJECT_%s_SIZE;' % _type.upper())
+        lines.append('      break;')
+    lines += ['    default:',
+              '      printf("bad type %d\\n", type);',
+              '      return;',
+              '    }',
+              '  }',
+              '}',
+              'int main() {']
+    for layer in tilemap.objectgroup_layers:
+        lines.append('  dump(map_%s_objs);' % layer.name)
+    lines += ['  return 0;', '}']
+    return '\n'.join(lines) + '\n'
+
+
+@requires_hostcc
+class ObjectPackingTest(unittest.TestCase):
+
+    def test_accessors(self):
+        maps = list(object_maps())
+        self.assertTrue(maps)
+        for path, raw in maps:
+            with self.subTest(map=os.path.relpath(path, TOP)), tempfile.TemporaryDirectory() as directory:
+                set_property(raw, 'rl_obj_pack', 'true')
+                tilemap = map2header.TiledMap(raw)
+                writer = map2header.TileMapWriter(tilemap, os.path.join(directory, 'map.h'))
+                writer.generate_headers()
+                packing = writer.object_packing
+                expected = []
+                for layer in tilemap.objectgroup_layers:
+                    for item in layer.raw_objects:
+                        _type, values = tilemap.object_schema.values(item)
+                        expected.append(' '.join(str(value) for value in [packing.types.index(_type)] + values))
+                output = run_program(directory, reader_program(tilemap, packing))
+                self.assertEqual(output.splitlines(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#
+#   RetroDeLuxe Engine for MSX
+#
+#   Checks the encodings map2header considers when a tile layer is
+#   compressed with rl_compr auto
+#
+import json
+import os
+import sys
+import unittest
+
+from hostcc import TOOLS, TOP, set_property
+
+sys.path.insert(0, TOOLS)
+
+import map2header
+
+MAP = os.path.join(TOP, 'test', 'map_test', 'res', 'map', 'map1.json')
+
+
+def auto_layer(segment, budget=None):
+    with open(MAP) as f:
+        raw = json.load(f)
+    set_property(raw, 'rl_compr', 'auto')
+    set_property(raw, 'rl_segment', 'true' if segment else 'false')
+    if budget is not None:
+        set_property(raw, 'rl_decode_budget', budget)
+    return map2header.TiledMap(raw).tile_layers[0]
+
+
+def considered(layer):
+    return [reason.split(':')[0] for reason in layer.mode_reasons]
+
+
+class SelectModeTest(unittest.TestCase):
+
+    def test_unsegmented(self):
+        layer = auto_layer(False)
+        self.assertIn('none', considered(layer))
+
+    def test_segmented(self):
+        layer = auto_layer(True)
+        self.assertNotIn('none', considered(layer))
+        self.assertIn(layer.mode, (3, 4, 7, 8))
+
+    def test_segmented_over_budget(self):
+        layer = auto_layer(True, '0.01')
+        self.assertIn(layer.mode, (3, 4, 7, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()